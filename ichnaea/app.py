@@ -2,8 +2,14 @@ from pyramid.config import Configurator
 from pyramid.tweens import EXCVIEW
 
 from ichnaea import customjson
-from ichnaea.cache import redis_client
+from ichnaea.cache import (
+    configure_response_cache,
+    configure_station_cache,
+    redis_client,
+)
 from ichnaea.db import (
+    configure_ping_idle,
+    configure_ro_database,
     Database,
     db_rw_session,
     db_ro_session,
@@ -25,17 +31,24 @@ def main(global_config, init=False,
     from ichnaea.logging import configure_raven
     from ichnaea.logging import configure_stats
     from ichnaea.service import configure_service
+    from ichnaea.service.base import (
+        configure_api_key_cache,
+        configure_rate_limiter,
+    )
+    from ichnaea.service.area import configure_cell_area_index
+    from ichnaea.service.locate import configure_concurrent_lookups
 
     configure_content(config)
     configure_service(config)
 
     # configure databases incl. test override hooks
     if _db_rw is None:
-        config.registry.db_rw = Database(settings['db_master'])
+        config.registry.db_rw = Database(
+            settings['db_master'], ping_idle=configure_ping_idle(settings))
     else:
         config.registry.db_rw = _db_rw
     if _db_ro is None:
-        config.registry.db_ro = Database(settings['db_slave'])
+        config.registry.db_ro = configure_ro_database(settings)
     else:
         config.registry.db_ro = _db_ro
 
@@ -46,6 +59,21 @@ def main(global_config, init=False,
     else:
         config.registry.redis_client = _redis
 
+    config.registry.station_cache = configure_station_cache(
+        settings, redis_client=config.registry.redis_client)
+    config.registry.response_cache = configure_response_cache(
+        settings, redis_client=config.registry.redis_client)
+    config.registry.api_key_cache = configure_api_key_cache(
+        settings, redis_client=config.registry.redis_client)
+    config.registry.rate_limiter = configure_rate_limiter(
+        settings, redis_client=config.registry.redis_client)
+    config.registry.cell_area_index = configure_cell_area_index(
+        settings, redis_client=config.registry.redis_client,
+        session_factory=config.registry.db_ro.session)
+    config.registry.concurrent_lookups = configure_concurrent_lookups(
+        settings, config.registry.db_ro.session,
+        max_overflow=config.registry.db_ro.max_overflow)
+
     config.registry.raven_client = raven_client = configure_raven(
         settings.get('sentry_dsn'), _client=_raven_client)
 
@@ -7,7 +7,10 @@ from ichnaea.app_config import read_config
 from ichnaea.async.schedule import CELERYBEAT_SCHEDULE
 from ichnaea.cache import redis_client
 from ichnaea import customjson
-from ichnaea.db import Database
+from ichnaea.db import (
+    configure_ping_idle,
+    Database,
+)
 from ichnaea.logging import (
     configure_raven,
     configure_stats,
@@ -38,7 +41,8 @@ register('internal_json', customjson.kombu_dumps, customjson.kombu_loads,
 def attach_database(app, settings=None, _db_rw=None):
     # called manually during tests
     if _db_rw is None:  # pragma: no cover
-        db_rw = Database(settings['db_master'])
+        db_rw = Database(settings['db_master'],
+                         ping_idle=configure_ping_idle(settings))
     else:
         db_rw = _db_rw
     app.db_rw = db_rw
@@ -78,6 +82,16 @@ def configure_ocid_import(app, settings=None):
     }
 
 
+def configure_observation_buffer(app, settings=None):
+    # called manually during tests
+    from ichnaea.data.observation import ObservationBuffer
+    app.observation_buffer = None
+    shards = int(settings.get('observation_buffer_shards', 0))
+    if shards:
+        app.observation_buffer = ObservationBuffer(
+            app.redis_client, shards=shards)
+
+
 def configure_celery(celery):
     conf = read_config()
     if conf.has_section('celery'):
@@ -28,6 +28,21 @@ CELERYBEAT_SCHEDULE = {
         'options': {'expires': 570},
     },
 
+    # Continuous observation insert tasks
+
+    'continuous-scan-observations-cell': {
+        'task': 'ichnaea.data.tasks.scan_observations',
+        'schedule': timedelta(seconds=5),
+        'args': ('cell', 5000),
+        'options': {'expires': 4},
+    },
+    'continuous-scan-observations-wifi': {
+        'task': 'ichnaea.data.tasks.scan_observations',
+        'schedule': timedelta(seconds=5),
+        'args': ('wifi', 5000),
+        'options': {'expires': 4},
+    },
+
     # Continuous location update tasks
 
     'location-update-cell-1': {
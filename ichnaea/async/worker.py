@@ -8,6 +8,7 @@ from ichnaea.async.config import (
     attach_redis_client,
     attach_stats_client,
     configure_s3_backup,
+    configure_observation_buffer,
     configure_ocid_import,
 )
 
@@ -25,3 +26,4 @@ def init_worker_process(signal, sender, **kw):  # pragma: no cover
     attach_stats_client(app, settings=settings)
     configure_s3_backup(app, settings=settings)
     configure_ocid_import(app, settings=settings)
+    configure_observation_buffer(app, settings=settings)
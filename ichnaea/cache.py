@@ -1,7 +1,15 @@
+from collections import OrderedDict
+import time
 import urlparse
 
 import redis
-from redis.exceptions import ConnectionError
+from redis.exceptions import (
+    ConnectionError,
+    RedisError,
+)
+import simplejson as json
+
+_MISSING = object()
 
 
 class RedisClient(redis.StrictRedis):
@@ -39,3 +47,217 @@ def redis_client(redis_url):
         socket_keepalive=True,
     )
     return RedisClient(connection_pool=pool)
+
+
+class ExpiringLRUCache(object):
+    """
+    A bounded in-process cache, in which every entry expires after
+    a time-to-live. If the cache is full, the least recently used
+    entry is evicted.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, _timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._timer = _timer
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires < self._timer():
+            return default
+        # re-insert the entry to mark it as the most recently used one
+        self._data[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._data.pop(key, None)
+        while len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+        self._data[key] = (self._timer() + ttl, value)
+
+
+class StationCache(object):
+    """
+    A two tier cache for station positions, consisting of a bounded
+    in-process cache and an optional Redis cache shared between all
+    web workers.
+
+    Entries are stored per namespace (usually a table name) and
+    hashkey. Negative lookups are cached as a `None` value.
+    """
+
+    log_stats = True
+
+    def __init__(self, redis_client=None, maxsize=100000, ttl=300):
+        self.local = ExpiringLRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    def _redis_key(self, namespace, key):
+        values = []
+        for field in key._fields:
+            value = getattr(key, field, None)
+            if isinstance(value, int):
+                # convert IntEnum's to plain numbers
+                value = int(value)
+            values.append(str(value))
+        return 'station_cache:%s:%s' % (namespace, ':'.join(values))
+
+    def get_many(self, namespace, keys):
+        """
+        Look up all keys in the cache.
+
+        Returns a tuple of a dictionary of all found cache entries and
+        a list of all keys which weren't found in the cache.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get((namespace, key), _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+
+        if not missing or self.redis_client is None:
+            return (found, missing)
+
+        try:
+            pipe = self.redis_client.pipeline()
+            for key in missing:
+                redis_key = self._redis_key(namespace, key)
+                pipe.get(redis_key)
+                pipe.pttl(redis_key)
+            results = pipe.execute()
+        except RedisError:  # pragma: no cover
+            return (found, missing)
+
+        not_cached = []
+        for i, key in enumerate(missing):
+            value, remaining = results[2 * i], results[2 * i + 1]
+            if value is None:
+                not_cached.append(key)
+                continue
+            value = json.loads(value)
+            if value is not None:
+                value = tuple(value)
+            # don't keep the entry locally for longer than it
+            # will still be around in redis
+            ttl = self.ttl
+            if remaining is not None and remaining > 0:
+                ttl = min(ttl, remaining / 1000.0)
+            self.local.set((namespace, key), value, ttl=ttl)
+            found[key] = value
+        return (found, not_cached)
+
+    def set_many(self, namespace, values):
+        """
+        Store all key/value pairs from the values dictionary in the cache.
+        """
+        for key, value in values.items():
+            self.local.set((namespace, key), value)
+
+        if not values or self.redis_client is None:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline()
+            for key, value in values.items():
+                pipe.setex(self._redis_key(namespace, key),
+                           self.ttl, json.dumps(value))
+            pipe.execute()
+        except RedisError:  # pragma: no cover
+            pass
+
+
+def configure_station_cache(settings, redis_client=None):
+    """
+    Configure a station cache based on the `station_cache_*` settings.
+    Returns `None` if no cache size was configured.
+    """
+    maxsize = int(settings.get('station_cache_size', 0))
+    if not maxsize:
+        return None
+    ttl = int(settings.get('station_cache_ttl', 300))
+    if settings.get('station_cache_redis', 'false').lower() != 'true':
+        redis_client = None
+    return StationCache(redis_client=redis_client, maxsize=maxsize, ttl=ttl)
+
+
+class ResponseCache(object):
+    """
+    A two tier cache for locate API responses, consisting of a bounded
+    in-process cache and an optional Redis cache shared between all
+    web workers.
+
+    Entries are stored per namespace (usually a searcher type) and
+    query fingerprint. Only found responses are cached.
+    """
+
+    def __init__(self, redis_client=None, maxsize=10000, ttl=60):
+        self.local = ExpiringLRUCache(maxsize=maxsize, ttl=ttl)
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    def _redis_key(self, namespace, fingerprint):
+        return 'response_cache:%s:%s' % (namespace, fingerprint)
+
+    def get(self, namespace, fingerprint):
+        """
+        Look up a cached response, returns `None` if there is none.
+        """
+        value = self.local.get((namespace, fingerprint))
+        if value is not None or self.redis_client is None:
+            return value
+
+        try:
+            value = self.redis_client.get(
+                self._redis_key(namespace, fingerprint))
+        except RedisError:  # pragma: no cover
+            return None
+
+        if value is not None:
+            value = json.loads(value)
+            self.local.set((namespace, fingerprint), value)
+        return value
+
+    def set(self, namespace, fingerprint, value):
+        """
+        Store a response in the cache.
+        """
+        self.local.set((namespace, fingerprint), value)
+
+        if self.redis_client is None:
+            return
+
+        try:
+            self.redis_client.setex(self._redis_key(namespace, fingerprint),
+                                    self.ttl, json.dumps(value))
+        except RedisError:  # pragma: no cover
+            pass
+
+
+def configure_response_cache(settings, redis_client=None):
+    """
+    Configure a locate response cache based on the `response_cache_*`
+    settings. Returns `None` if no cache size was configured.
+    """
+    maxsize = int(settings.get('response_cache_size', 0))
+    if not maxsize:
+        return None
+    ttl = int(settings.get('response_cache_ttl', 60))
+    if settings.get('response_cache_redis', 'false').lower() != 'true':
+        redis_client = None
+    return ResponseCache(redis_client=redis_client, maxsize=maxsize, ttl=ttl)
@@ -30,6 +30,63 @@ def decode_radio_dict(dct):
     return dct
 
 
+def encode_columns(entries, shared=()):
+    """
+    Encode a list of dicts into a compact columnar structure.
+
+    Entries with the same keys are stored as one block, holding each
+    key once and the values as parallel lists. The values of the
+    `shared` keys are stored once per distinct combination in `rows`,
+    which each entry references by its index in `row`.
+    """
+    blocks = {}
+    for entry in entries:
+        keys = frozenset(entry)
+        block = blocks.get(keys)
+        if block is None:
+            own = tuple(sorted([key for key in keys if key not in shared]))
+            common = tuple([key for key in shared if key in keys])
+            block = blocks[keys] = {
+                'fields': list(own),
+                'columns': [[] for key in own],
+                'shared': list(common),
+                'rows': [],
+                'row': [],
+                'index': {},
+            }
+        for key, column in zip(block['fields'], block['columns']):
+            column.append(entry[key])
+        values = tuple([entry[key] for key in block['shared']])
+        index = block['index'].get(values)
+        if index is None:
+            index = block['index'][values] = len(block['rows'])
+            block['rows'].append(list(values))
+        block['row'].append(index)
+
+    for block in blocks.values():
+        del block['index']
+    return {'blocks': list(blocks.values())}
+
+
+def decode_columns(value):
+    """
+    Decode a structure created by :func:`encode_columns` back into a
+    list of dicts. The original order is kept within each block.
+    """
+    entries = []
+    for block in value['blocks']:
+        fields = block['fields']
+        shared = block['shared']
+        rows = block['rows']
+        columns = block['columns']
+        for i, index in enumerate(block['row']):
+            entry = dict(zip(shared, rows[index]))
+            for key, column in zip(fields, columns):
+                entry[key] = column[i]
+            entries.append(entry)
+    return entries
+
+
 def custom_iterencode(value):
     from simplejson.encoder import (
         _make_iterencode,
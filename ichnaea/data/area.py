@@ -17,6 +17,7 @@ UPDATE_KEY = {
     'cell_lac': 'update_cell_lac',
     'wifi': 'update_wifi',
 }
+AREA_CHANNEL = 'cell_area_update'
 
 
 def enqueue_areas(session, redis_client, area_keys,
@@ -41,6 +42,15 @@ def dequeue_areas(redis_client, pipeline_key, batch=100):
     return [kombu_loads(item) for item in pipe.execute()[0]]
 
 
+def publish_area_update(redis_client, area_model, area_key):
+    """
+    Tell all web workers to refresh their in-memory cell area index
+    entry for the given area.
+    """
+    redis_client.publish(AREA_CHANNEL, kombu_dumps(
+        {'table': area_model.__tablename__, 'key': area_key}))
+
+
 class CellAreaUpdater(DataTask):
 
     cell_model = Cell
@@ -110,7 +120,7 @@ class CellAreaUpdater(DataTask):
                     range=rng,
                     avg_cell_range=avg_cell_range,
                     num_cells=num_cells,
-                    **area_key.__dict__)
+                    **area_key._to_dict())
                 self.session.add(area)
             else:
                 area.modified = self.utcnow
@@ -120,6 +130,13 @@ class CellAreaUpdater(DataTask):
                 area.avg_cell_range = avg_cell_range
                 area.num_cells = num_cells
 
+    def publish(self, area_key):
+        """
+        Publish a change of the area, after it has been committed.
+        """
+        publish_area_update(
+            self.redis_client, self.cell_area_model, area_key)
+
 
 class OCIDCellAreaUpdater(CellAreaUpdater):
 
@@ -1,4 +1,6 @@
 from collections import defaultdict
+import uuid
+from zlib import crc32
 
 from sqlalchemy.orm import load_only
 
@@ -6,7 +8,11 @@ from ichnaea.constants import (
     PERMANENT_BLACKLIST_THRESHOLD,
     TEMPORARY_BLACKLIST_DURATION,
 )
-from ichnaea.customjson import decode_radio_dict
+from ichnaea.customjson import (
+    decode_radio_dict,
+    kombu_dumps,
+    kombu_loads,
+)
 from ichnaea.data.base import DataTask
 from ichnaea.models import (
     Cell,
@@ -48,37 +54,48 @@ class ObservationQueue(DataTask):
     def insert(self, entries, userid=None):
         all_observations = []
         drop_counter = defaultdict(int)
-        new_stations = 0
+        new_stations = set()
 
-        # Process entries and group by validated station key
+        # Process entries and group by validated station key. The
+        # observations are validated into plain dicts, as they are
+        # only ever inserted and never read back in this session.
         station_observations = defaultdict(list)
         for entry in entries:
             self.pre_process_entry(entry)
 
-            obs = self.observation_model.create(**entry)
-            if not obs:
+            obs = self.observation_model.validate(entry)
+            if obs is None:
                 drop_counter['malformed'] += 1
                 continue
 
-            station_observations[obs.hashkey()].append(obs)
+            obs_key = self.observation_model.to_hashkey(obs)
+            station_observations[obs_key].append(obs)
+
+        # Look up all stations and blacklist entries of the batch at once
+        stations = self.known_stations(station_observations.keys())
+        blacklist = self.blacklisted_stations(
+            [key for key in station_observations.keys()
+             if self.station_model.to_hashkey(key) not in stations])
 
-        # Process observations one station at a time
+        station_counts = {}
         for key, observations in station_observations.items():
             first_blacklisted = None
             incomplete = False
-            station = self.station_model.querykey(self.session, key).first()
 
-            if station is None:
+            station_key = self.station_model.to_hashkey(key)
+            if station_key not in stations:
                 # Drop observations for blacklisted stations.
-                blacklisted, first_blacklisted = self.blacklisted_station(key)
+                blacklisted, first_blacklisted = blacklist.get(
+                    self.blacklist_model.to_hashkey(key), (False, None))
                 if blacklisted:
                     drop_counter['blacklisted'] += len(observations)
                     continue
 
                 incomplete = self.incomplete_observation(key)
                 if not incomplete:
-                    # We discovered an actual new complete station.
-                    new_stations += 1
+                    # We discovered an actual new complete station,
+                    # possibly seen with different observation keys.
+                    new_stations.add(station_key)
 
             # Accept all observations
             all_observations.extend(observations)
@@ -87,64 +104,105 @@ class ObservationQueue(DataTask):
             # Accept incomplete observations, just don't make stations for them
             # (station creation is a side effect of count-updating)
             if not incomplete and num > 0:
-                self.create_or_update_station(station, key, num,
-                                              first_blacklisted)
+                station_counts[key] = (num, first_blacklisted)
+
+        self.create_or_update_stations(station_counts, stations)
 
         # Credit the user with discovering any new stations.
-        if userid is not None and new_stations > 0:
+        if userid is not None and new_stations:
             scorekey = Score.to_hashkey(
                 userid=userid,
                 key=ScoreKey['new_' + self.station_type],
                 time=self.utcnow.date())
-            Score.incr(self.session, scorekey, new_stations)
+            Score.incr(self.session, scorekey, len(new_stations))
 
         added = len(all_observations)
         self.emit_stats(added, drop_counter)
 
-        self.session.add_all(all_observations)
+        self.insert_observations(all_observations)
         return added
 
-    def blacklisted_station(self, key):
-        query = (self.blacklist_model.querykey(self.session, key)
+    def insert_observations(self, observations):
+        """
+        Insert the validated observation dicts with a single
+        executemany insert statement.
+        """
+        if not observations:
+            return
+        table = self.observation_model.__table__
+        column_keys = tuple(sorted(observations[0].keys()))
+        # the column keys are part of the compiled statement
+        self.session.execute_cached(
+            ('insert_observations', table.name, column_keys),
+            table.insert, observations, column_keys=column_keys)
+
+    def known_stations(self, keys):
+        """
+        Return a dict mapping station hashkeys to all stations which
+        exist for the given observation keys.
+        """
+        if not keys:
+            return {}
+        fields = self.station_model._hashkey_cls._fields
+        query = (self.station_model.querykeys(self.session, keys)
+                                   .options(load_only(*fields)))
+        return dict([(station.hashkey(), station) for station in query.all()])
+
+    def blacklisted_stations(self, keys):
+        """
+        Return a dict mapping blacklist hashkeys to a tuple of
+        `(blacklisted, first_blacklisted)` for all blacklist entries
+        of the given observation keys.
+        """
+        if not keys:
+            return {}
+        query = (self.blacklist_model.querykeys(self.session, keys)
                                      .options(load_only('count', 'time')))
-        black = query.first()
-        if black is not None:
+        result = {}
+        for black in query.all():
             age = self.utcnow - black.time
             temp_blacklisted = age < TEMPORARY_BLACKLIST_DURATION
             perm_blacklisted = black.count >= PERMANENT_BLACKLIST_THRESHOLD
-            if temp_blacklisted or perm_blacklisted:
-                return (True, black.time)
-            return (False, black.time)
-        return (False, None)
+            result[black.hashkey()] = (
+                temp_blacklisted or perm_blacklisted, black.time)
+        return result
 
     def incomplete_observation(self, key):
         return False
 
-    def create_or_update_station(self, station, key, num,
-                                 first_blacklisted):
-        # Creates a station or updates its new/total_measures counts to
-        # reflect recently-received observations.
-        if station is not None:
-            station.new_measures += num
-            station.total_measures += num
-        else:
-            created = self.utcnow
-            if first_blacklisted:
-                # if the station did previously exist, retain at least the
-                # time it was first put on a blacklist as the creation date
-                created = first_blacklisted
-            stmt = self.station_model.__table__.insert(
-                on_duplicate='new_measures = new_measures + %s, '
-                             'total_measures = total_measures + %s' % (
-                                 num, num)
-            ).values(
-                created=created,
+    def create_or_update_stations(self, station_counts, stations):
+        """
+        Create stations or update their new/total_measures counts to
+        reflect recently-received observations, in batched upserts.
+
+        :param station_counts: A dict mapping observation keys to a
+            tuple of `(num, first_blacklisted)`.
+        :param stations: The already known stations, as returned by
+            :meth:`known_stations`.
+        """
+        if not station_counts:
+            return
+
+        rows = []
+        for key in sorted(station_counts.keys(),
+                          key=lambda key: key._values):
+            num, first_blacklisted = station_counts[key]
+            # if the station did previously exist, retain at least the
+            # time it was first put on a blacklist as the creation date
+            rows.append(dict(
+                created=first_blacklisted or self.utcnow,
                 modified=self.utcnow,
                 range=0,
                 new_measures=num,
                 total_measures=num,
-                **key.__dict__)
-            self.session.execute(stmt)
+                **key._to_dict()))
+
+        self.session.upsert(self.station_model.__table__, rows,
+                            increment=('new_measures', 'total_measures'))
+
+        # the counters of already loaded stations are out of date now
+        for station in stations.values():
+            self.session.expire(station, ['new_measures', 'total_measures'])
 
 
 class CellObservationQueue(ObservationQueue):
@@ -176,3 +234,149 @@ class WifiObservationQueue(ObservationQueue):
     station_model = Wifi
     observation_model = WifiObservation
     blacklist_model = WifiBlacklist
+
+
+# delete a lock, but only if it's still held by the given token
+UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class ObservationBuffer(object):
+    """
+    Buffers observations in Redis lists until the drain task inserts
+    them in bulk.
+
+    The lists are sharded by a hash of the station key, so all
+    observations of one station end up in the same shard. Each shard
+    is drained by only one task at a time, guarded by a lock, so
+    concurrent drain tasks never update the same stations.
+    """
+
+    station_models = {
+        'cell': Cell,
+        'wifi': Wifi,
+    }
+
+    def __init__(self, redis_client, shards=16, expire=86400):
+        self.redis_client = redis_client
+        self.shards = shards
+        self.expire = expire
+
+    def key(self, station_type, shard):
+        return 'observations_%s_%d' % (station_type, shard)
+
+    def shard(self, station_type, obs):
+        station_key = self.station_models[station_type].to_hashkey(obs)
+        value = ':'.join([str(value) for value in station_key._values])
+        return (crc32(value) & 0xffffffff) % self.shards
+
+    def push(self, station_type, observations, userid=None):
+        """
+        Add observations to the buffer. Cell observations need to be
+        encoded with :func:`ichnaea.customjson.encode_radio_dict`.
+        """
+        shards = defaultdict(list)
+        for obs in observations:
+            shards[self.shard(station_type, obs)].append(
+                str(kombu_dumps([userid, obs])))
+        pipe = self.redis_client.pipeline()
+        for shard, items in shards.items():
+            self._rpush(pipe, self.key(station_type, shard), items)
+        pipe.execute()
+
+    def pop(self, station_type, shard, batch=5000):
+        """
+        Remove and return up to `batch` encoded items from one shard.
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.multi()
+        key = self.key(station_type, shard)
+        pipe.lrange(key, 0, batch - 1)
+        pipe.ltrim(key, batch, -1)
+        return pipe.execute()[0]
+
+    def requeue(self, station_type, shard, items):
+        """
+        Put items returned by :meth:`pop` back into their shard.
+        """
+        if not items:
+            return
+        pipe = self.redis_client.pipeline()
+        self._rpush(pipe, self.key(station_type, shard), items)
+        pipe.execute()
+
+    def lock(self, station_type, shard, timeout=300):
+        """
+        Try to lock one shard for draining. Returns a token to pass to
+        :meth:`unlock`, or `None` if the shard is already locked.
+        The lock expires after `timeout` seconds.
+        """
+        token = uuid.uuid4().hex
+        key = self.key(station_type, shard) + '_lock'
+        if self.redis_client.set(key, token, nx=True, ex=timeout):
+            return token
+        return None
+
+    def unlock(self, station_type, shard, token):
+        key = self.key(station_type, shard) + '_lock'
+        self.redis_client.eval(UNLOCK_SCRIPT, 1, key, token)
+
+    def lengths(self, station_type):
+        """
+        Return a list of the number of buffered items per shard.
+        """
+        pipe = self.redis_client.pipeline()
+        for shard in range(self.shards):
+            pipe.llen(self.key(station_type, shard))
+        return pipe.execute()
+
+    def _rpush(self, pipe, key, items, batch=1000):
+        for i in range(0, len(items), batch):
+            pipe.rpush(key, *items[i:i + batch])
+        # Expire key after 24 hours
+        pipe.expire(key, self.expire)
+
+
+class ObservationDrainer(DataTask):
+
+    queue_classes = {
+        'cell': CellObservationQueue,
+        'wifi': WifiObservationQueue,
+    }
+
+    def __init__(self, task, session, buffer):
+        DataTask.__init__(self, task, session)
+        self.buffer = buffer
+
+    def scan(self, drain_task, station_type, batch=5000):
+        shards = 0
+        for shard, length in enumerate(self.buffer.lengths(station_type)):
+            if length:
+                # expire the task if it wasn't processed after a minute,
+                # later scans will start a new one
+                drain_task.apply_async(
+                    args=[station_type, shard],
+                    kwargs={'batch': batch},
+                    expires=60)
+                shards += 1
+        return shards
+
+    def insert(self, station_type, items, utcnow=None):
+        # group by user, so new stations are credited to the right user
+        users = defaultdict(list)
+        for item in items:
+            userid, obs = kombu_loads(item)
+            users[userid].append(obs)
+
+        if utcnow is None:
+            utcnow = util.utcnow()
+        queue_class = self.queue_classes[station_type]
+        length = 0
+        for userid, observations in users.items():
+            queue = queue_class(self.task, self.session, utcnow=utcnow)
+            length += queue.insert(observations, userid=userid)
+        return length
@@ -3,7 +3,10 @@ import uuid
 
 from sqlalchemy.sql import and_, or_
 
-from ichnaea.customjson import encode_radio_dict
+from ichnaea.customjson import (
+    encode_columns,
+    encode_radio_dict,
+)
 from ichnaea.data.base import DataTask
 from ichnaea.models import (
     CellObservation,
@@ -18,17 +21,25 @@ from ichnaea.models import (
 )
 from ichnaea import util
 
+# fields copied from the report into each of its observations
+REPORT_FIELDS = (
+    'lat', 'lon', 'time', 'accuracy', 'report_id', 'altitude',
+    'altitude_accuracy', 'heading', 'speed', 'created',
+)
+
 
 class ReportQueue(DataTask):
 
     def __init__(self, task, session,
                  api_key_log=False, api_key_name=None,
-                 insert_cell_task=None, insert_wifi_task=None):
+                 insert_cell_task=None, insert_wifi_task=None,
+                 observation_buffer=None):
         DataTask.__init__(self, task, session)
         self.api_key_log = api_key_log
         self.api_key_name = api_key_name
         self.insert_cell_task = insert_cell_task
         self.insert_wifi_task = insert_wifi_task
+        self.observation_buffer = observation_buffer
 
     def insert(self, reports, nickname='', email=''):
 
@@ -70,29 +81,13 @@ class ReportQueue(DataTask):
                     'cell_observations' % self.api_key_name,
                     len(cell_observations))
 
-            cells = defaultdict(list)
-            for obs in cell_observations:
-                cells[CellObservation.to_hashkey(obs)].append(obs)
-
-            # Create a task per group of 5 cell keys at a time.
-            # Grouping them helps in avoiding per-task overhead.
-            cells = list(cells.values())
-            batch_size = 5
-            countdown = 0
-            for i in range(0, len(cells), batch_size):
-                values = []
-                for observations in cells[i:i + batch_size]:
-                    values.extend([encode_radio_dict(o) for o in observations])
-                # insert observations, expire the task if it wasn't processed
-                # after six hours to avoid queue overload, also delay
-                # each task by one second more, to get a more even workload
-                # and avoid parallel updates of the same underlying stations
-                self.insert_cell_task.apply_async(
-                    args=[values],
-                    kwargs={'userid': userid},
-                    expires=21600,
-                    countdown=countdown)
-                countdown += 1
+            if self.observation_buffer is not None:
+                # leave the bulk insert to the drain task
+                self.observation_buffer.push(
+                    'cell', [encode_radio_dict(o) for o in cell_observations],
+                    userid=userid)
+            else:
+                self.queue_cell_tasks(cell_observations, userid=userid)
 
         if wifi_observations:
             # group by WiFi key
@@ -104,31 +99,12 @@ class ReportQueue(DataTask):
                     'wifi_observations' % self.api_key_name,
                     len(wifi_observations))
 
-            wifis = defaultdict(list)
-            for obs in wifi_observations:
-                wifis[WifiObservation.to_hashkey(obs)].append(obs)
-
-            # Create a task per group of 20 WiFi keys at a time.
-            # We tend to get a huge number of unique WiFi networks per
-            # batch upload, with one to very few observations per WiFi.
-            # Grouping them helps in avoiding per-task overhead.
-            wifis = list(wifis.values())
-            batch_size = 20
-            countdown = 0
-            for i in range(0, len(wifis), batch_size):
-                values = []
-                for observations in wifis[i:i + batch_size]:
-                    values.extend(observations)
-                # insert observations, expire the task if it wasn't processed
-                # after six hours to avoid queue overload, also delay
-                # each task by one second more, to get a more even workload
-                # and avoid parallel updates of the same underlying stations
-                self.insert_wifi_task.apply_async(
-                    args=[values],
-                    kwargs={'userid': userid},
-                    expires=21600,
-                    countdown=countdown)
-                countdown += 1
+            if self.observation_buffer is not None:
+                # leave the bulk insert to the drain task
+                self.observation_buffer.push(
+                    'wifi', wifi_observations, userid=userid)
+            else:
+                self.queue_wifi_tasks(wifi_observations, userid=userid)
 
         if userid is not None:
             scorekey = Score.to_hashkey(
@@ -139,6 +115,60 @@ class ReportQueue(DataTask):
         if positions:
             self.process_mapstat(positions)
 
+    def queue_cell_tasks(self, cell_observations, userid=None):
+        cells = defaultdict(list)
+        for obs in cell_observations:
+            cells[CellObservation.to_hashkey(obs)].append(obs)
+
+        # Create a task per group of 5 cell keys at a time.
+        # Grouping them helps in avoiding per-task overhead.
+        cells = list(cells.values())
+        batch_size = 5
+        countdown = 0
+        for i in range(0, len(cells), batch_size):
+            values = []
+            for observations in cells[i:i + batch_size]:
+                values.extend([encode_radio_dict(o) for o in observations])
+            # insert observations, expire the task if it wasn't processed
+            # after six hours to avoid queue overload, also delay
+            # each task by one second more, to get a more even workload
+            # and avoid parallel updates of the same underlying stations
+            self.insert_cell_task.apply_async(
+                args=[values],
+                kwargs={'userid': userid},
+                expires=21600,
+                countdown=countdown)
+            countdown += 1
+
+    def queue_wifi_tasks(self, wifi_observations, userid=None):
+        wifis = defaultdict(list)
+        for obs in wifi_observations:
+            wifis[WifiObservation.to_hashkey(obs)].append(obs)
+
+        # Create a task per group of 20 WiFi keys at a time.
+        # We tend to get a huge number of unique WiFi networks per
+        # batch upload, with one to very few observations per WiFi.
+        # Grouping them helps in avoiding per-task overhead.
+        wifis = list(wifis.values())
+        batch_size = 20
+        countdown = 0
+        for i in range(0, len(wifis), batch_size):
+            values = []
+            for observations in wifis[i:i + batch_size]:
+                values.extend(observations)
+            # insert observations, expire the task if it wasn't processed
+            # after six hours to avoid queue overload, also delay
+            # each task by one second more, to get a more even workload
+            # and avoid parallel updates of the same underlying stations.
+            # The observations of a report often share a task, so send
+            # their report fields only once.
+            self.insert_wifi_task.apply_async(
+                args=[encode_columns(values, shared=REPORT_FIELDS)],
+                kwargs={'userid': userid},
+                expires=21600,
+                countdown=countdown)
+            countdown += 1
+
     def process_report(self, data):
         def add_missing_dict_entries(dst, src):
             # x.update(y) overwrites entries in x with those in y;
@@ -217,13 +247,13 @@ class ReportQueue(DataTask):
         prior = {}
         for r in result:
             prior[(r[0], r[1])] = True
-        for (lat, lon) in tiles.keys():
+        rows = []
+        for (lat, lon) in sorted(tiles.keys()):
             old = prior.get((lat, lon), False)
             if not old:
-                stmt = MapStat.__table__.insert(
-                    on_duplicate='id = id').values(
-                    time=today, lat=lat, lon=lon)
-                self.session.execute(stmt)
+                rows.append({'time': today, 'lat': lat, 'lon': lon})
+        # tiles added concurrently by other tasks are left unchanged
+        self.session.upsert(MapStat.__table__, rows)
 
     def process_user(self, nickname, email):
         userid = None
@@ -182,7 +182,7 @@ class StationUpdater(DataTask):
                 blacklisted_station = self.blacklist_model(
                     time=utcnow,
                     count=1,
-                    **station_key.__dict__)
+                    **station_key._to_dict())
                 self.session.add(blacklisted_station)
 
         if moving_keys:
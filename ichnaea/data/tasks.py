@@ -1,11 +1,15 @@
 from ichnaea.async.task import DatabaseTask
-from ichnaea.customjson import kombu_loads
+from ichnaea.customjson import (
+    decode_columns,
+    kombu_loads,
+)
 from ichnaea.data.area import (
     CellAreaUpdater,
     OCIDCellAreaUpdater,
 )
 from ichnaea.data.observation import (
     CellObservationQueue,
+    ObservationDrainer,
     WifiObservationQueue,
 )
 from ichnaea.data.report import ReportQueue
@@ -34,7 +38,9 @@ def insert_measures(self, items=None, nickname='', email='',
                             api_key_log=api_key_log,
                             api_key_name=api_key_name,
                             insert_cell_task=insert_measures_cell,
-                            insert_wifi_task=insert_measures_wifi)
+                            insert_wifi_task=insert_measures_wifi,
+                            observation_buffer=getattr(
+                                self.app, 'observation_buffer', None))
         length = queue.insert(reports, nickname=nickname, email=email)
         session.commit()
     return length
@@ -42,6 +48,9 @@ def insert_measures(self, items=None, nickname='', email='',
 
 @celery.task(base=DatabaseTask, bind=True, queue='celery_insert')
 def insert_measures_cell(self, entries, userid=None, utcnow=None):
+    if isinstance(entries, dict):
+        # sent by the report queue as columns
+        entries = decode_columns(entries)
     with self.db_session() as session:
         queue = CellObservationQueue(self, session, utcnow=utcnow)
         length = queue.insert(entries, userid=userid)
@@ -51,6 +60,9 @@ def insert_measures_cell(self, entries, userid=None, utcnow=None):
 
 @celery.task(base=DatabaseTask, bind=True, queue='celery_insert')
 def insert_measures_wifi(self, entries, userid=None, utcnow=None):
+    if isinstance(entries, dict):
+        # sent by the report queue as columns
+        entries = decode_columns(entries)
     with self.db_session() as session:
         queue = WifiObservationQueue(self, session, utcnow=utcnow)
         length = queue.insert(entries, userid=userid)
@@ -58,6 +70,40 @@ def insert_measures_wifi(self, entries, userid=None, utcnow=None):
     return length
 
 
+@celery.task(base=DatabaseTask, bind=True)
+def scan_observations(self, station_type, batch=5000):
+    buffer = getattr(self.app, 'observation_buffer', None)
+    if buffer is None:
+        return 0
+    drainer = ObservationDrainer(self, None, buffer)
+    return drainer.scan(drain_observations, station_type, batch=batch)
+
+
+@celery.task(base=DatabaseTask, bind=True, queue='celery_insert')
+def drain_observations(self, station_type, shard, batch=5000, utcnow=None):
+    buffer = self.app.observation_buffer
+    # skip the shard if another task is still draining it
+    token = buffer.lock(station_type, shard)
+    if token is None:
+        return 0
+    try:
+        items = buffer.pop(station_type, shard, batch=batch)
+        if not items:
+            return 0
+        try:
+            with self.db_session() as session:
+                drainer = ObservationDrainer(self, session, buffer)
+                length = drainer.insert(station_type, items, utcnow=utcnow)
+                session.commit()
+        except Exception:
+            # put the observations back, to be retried by the next drain
+            buffer.requeue(station_type, shard, items)
+            raise
+    finally:
+        buffer.unlock(station_type, shard, token)
+    return length
+
+
 @celery.task(base=DatabaseTask, bind=True)
 def location_update_cell(self, min_new=10, max_new=100, batch=10):
     with self.db_session() as session:
@@ -142,3 +188,4 @@ def update_area(self, area_key, cell_type='cell'):
             updater = CellAreaUpdater(self, session)
         updater.update(area_key)
         session.commit()
+        updater.publish(area_key)
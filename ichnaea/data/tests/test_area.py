@@ -1,4 +1,8 @@
+import time
+
+from ichnaea.customjson import kombu_loads
 from ichnaea.data.area import (
+    AREA_CHANNEL,
     enqueue_areas,
     UPDATE_KEY,
 )
@@ -206,6 +210,21 @@ class TestArea(CeleryTestCase):
         areas = session.query(CellArea).all()
         self.assertEqual(areas, [])
 
+    def test_scan_areas_publish(self):
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(AREA_CHANNEL)
+        area = CellAreaFactory()
+        self.session.flush()
+        enqueue_areas(self.session, self.redis_client,
+                      [area.hashkey()], UPDATE_KEY['cell_lac'])
+        self.assertEqual(scan_areas.delay().get(), 1)
+
+        time.sleep(0.05)
+        message = pubsub.get_message()
+        pubsub.reset()
+        self.assertEqual(kombu_loads(message['data']),
+                         {'table': 'cell_area', 'key': area.hashkey()})
+
     def test_scan_areas_update(self):
         session = self.session
         self.add_line_of_cells_and_scan_lac()
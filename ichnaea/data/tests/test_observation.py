@@ -6,9 +6,19 @@ from sqlalchemy import text
 from ichnaea.constants import (
     TEMPORARY_BLACKLIST_DURATION,
 )
+from ichnaea.customjson import (
+    encode_columns,
+    encode_radio_dict,
+    kombu_dumps,
+)
+from ichnaea.data.observation import ObservationBuffer
+from ichnaea.data.report import REPORT_FIELDS
 from ichnaea.data.tasks import (
+    drain_observations,
+    insert_measures,
     insert_measures_cell,
     insert_measures_wifi,
+    scan_observations,
 )
 from ichnaea.models import (
     constants,
@@ -18,6 +28,7 @@ from ichnaea.models import (
     Radio,
     Score,
     ScoreKey,
+    User,
     ValidCellKeySchema,
     Wifi,
     WifiBlacklist,
@@ -27,6 +38,7 @@ from ichnaea.tests.base import (
     CeleryTestCase,
     PARIS_LAT, PARIS_LON, FRANCE_MCC,
 )
+from ichnaea.worker import celery
 from ichnaea import util
 
 
@@ -147,6 +159,22 @@ class TestCell(CeleryTestCase):
         observations = session.query(CellObservation).all()
         self.assertEqual(len(observations), 8)
 
+    def test_new_cell_with_different_psc(self):
+        session = self.session
+        entries = [dict(radio=int(Radio.gsm), mcc=FRANCE_MCC, mnc=2,
+                        lac=3, cid=4, psc=psc,
+                        lat=PARIS_LAT, lon=PARIS_LON)
+                   for psc in (5, 6)]
+        result = insert_measures_cell.delay(entries, userid=1)
+        self.assertEqual(result.get(), 2)
+        self.assertEqual(session.query(Cell).count(), 1)
+
+        # the new cell is only credited once
+        scores = session.query(Score).all()
+        self.assertEqual(len(scores), 1)
+        self.assertEqual(scores[0].key, ScoreKey.new_cell)
+        self.assertEqual(scores[0].value, 1)
+
     def test_insert_observations_invalid_lac(self):
         session = self.session
         schema = ValidCellKeySchema()
@@ -269,6 +297,54 @@ class TestWifi(CeleryTestCase):
         # and the creation date was set to the date of the blacklist entry
         self.assertEqual(wifis[0].created, last_week)
 
+    def test_insert_columns(self):
+        session = self.session
+        entries = [dict(key='%012x' % (i % 2 + 1), channel=i,
+                        lat=1.0, lon=2.0)
+                   for i in range(3)]
+        result = insert_measures_wifi.delay(
+            encode_columns(entries, shared=REPORT_FIELDS), userid=1)
+        self.assertEqual(result.get(), 3)
+
+        observations = session.query(WifiObservation).all()
+        self.assertEqual(sorted([obs.channel for obs in observations]),
+                         [0, 1, 2])
+        self.assertEqual(set([obs.lat for obs in observations]), set([1.0]))
+        self.assertEqual(session.query(Wifi).count(), 2)
+
+    def test_bulk_lookup(self):
+        session = self.session
+        utcnow = util.utcnow()
+        keys = ['%012x' % i for i in range(20)]
+        session.add_all([Wifi(key=key, new_measures=1, total_measures=2)
+                         for key in keys[:10]])
+        session.add_all([WifiBlacklist(key=key, time=utcnow, count=1)
+                         for key in keys[10:12]])
+        session.flush()
+
+        entries = [dict(key=key, lat=1.0, lon=2.0) for key in keys]
+        with self.db_call_checker():
+            insert_measures_wifi.delay(entries).get()
+            statements = [statement for (statement, parameters)
+                          in self.db_events['rw']['calls']]
+        # one query each for the stations and the blacklist entries
+        self.assertEqual(len([stmt for stmt in statements
+                              if stmt.startswith('SELECT')]), 2)
+        self.assertEqual(len([stmt for stmt in statements
+                              if stmt.startswith('INSERT INTO wifi ')]), 1)
+        # and a single executemany insert for all observations
+        self.assertEqual(
+            len([stmt for stmt in statements
+                 if stmt.startswith('INSERT INTO wifi_measure ')]), 1)
+        self.assertEqual(session.query(WifiObservation).count(), 18)
+
+        wifis = dict([(wifi.key, wifi) for wifi in session.query(Wifi)])
+        self.assertEqual(len(wifis), 18)
+        self.assertEqual(wifis[keys[0]].new_measures, 2)
+        self.assertEqual(wifis[keys[0]].total_measures, 3)
+        self.assertEqual(wifis[keys[19]].new_measures, 1)
+        self.assertEqual(wifis[keys[19]].total_measures, 1)
+
     def test_insert_observations(self):
         session = self.session
         time = util.utcnow() - timedelta(days=1)
@@ -328,6 +404,106 @@ class TestWifi(CeleryTestCase):
         self.assertEqual(len(observations), 8)
 
 
+class TestObservationBuffer(CeleryTestCase):
+
+    def setUp(self):
+        super(TestObservationBuffer, self).setUp()
+        self.buffer = celery.observation_buffer = ObservationBuffer(
+            self.redis_client, shards=4)
+
+    def tearDown(self):
+        celery.observation_buffer = None
+        super(TestObservationBuffer, self).tearDown()
+
+    def test_shard(self):
+        cell = encode_radio_dict(dict(radio=Radio.gsm, mcc=FRANCE_MCC,
+                                      mnc=2, lac=3, cid=4))
+        shard = self.buffer.shard('cell', cell)
+        self.assertEqual(self.buffer.shard('cell', dict(cell, psc=5)), shard)
+        self.assertEqual(len(set([
+            self.buffer.shard('wifi', dict(key='%012x' % i))
+            for i in range(100)])), 4)
+
+    def test_pop_requeue(self):
+        wifis = [dict(key='%012x' % i, lat=1.0, lon=2.0) for i in range(3)]
+        self.buffer.push('wifi', wifis * 3)
+        shard = self.buffer.shard('wifi', wifis[0])
+        length = self.buffer.lengths('wifi')[shard]
+        items = self.buffer.pop('wifi', shard, batch=2)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(self.buffer.lengths('wifi')[shard], length - 2)
+        self.buffer.requeue('wifi', shard, items)
+        self.assertEqual(self.buffer.lengths('wifi')[shard], length)
+
+    def test_insert_measures(self):
+        session = self.session
+        reports = [dict(
+            lat=PARIS_LAT, lon=PARIS_LON + i * 0.0001,
+            cell=[dict(radio='gsm', mcc=FRANCE_MCC, mnc=2, lac=3, cid=4)],
+            wifi=[dict(key='%012x' % (i % 3 + 1)) for i in range(i, i + 2)],
+        ) for i in range(5)]
+        insert_measures.delay(
+            items=kombu_dumps(reports), nickname='tester').get()
+
+        # the observations are buffered
+        self.assertEqual(session.query(WifiObservation).count(), 0)
+        self.assertEqual(sum(self.buffer.lengths('cell')), 5)
+        self.assertEqual(sum(self.buffer.lengths('wifi')), 10)
+
+        # and inserted by the drain tasks
+        self.assertEqual(scan_observations.delay('cell').get(), 1)
+        shards = set([self.buffer.shard('wifi', dict(key='%012x' % i))
+                      for i in range(1, 4)])
+        self.assertEqual(scan_observations.delay('wifi').get(), len(shards))
+        self.assertEqual(sum(self.buffer.lengths('wifi')), 0)
+        self.assertEqual(session.query(CellObservation).count(), 5)
+        self.assertEqual(session.query(WifiObservation).count(), 10)
+        cells = session.query(Cell).all()
+        self.assertEqual(len(cells), 1)
+        self.assertEqual(cells[0].new_measures, 5)
+        self.assertEqual(session.query(Wifi).count(), 3)
+
+        userid = session.query(User).one().id
+        scores = dict([(score.key, score.value)
+                       for score in session.query(Score).filter(
+                           Score.userid == userid)])
+        self.assertEqual(scores[ScoreKey.new_cell], 1)
+        self.assertEqual(scores[ScoreKey.new_wifi], 3)
+
+        self.assertEqual(drain_observations.delay('wifi', 0).get(), 0)
+
+    def test_lock(self):
+        token = self.buffer.lock('wifi', 1)
+        self.assertTrue(token is not None)
+        self.assertTrue(self.buffer.lock('wifi', 1) is None)
+        self.assertTrue(self.buffer.lock('wifi', 2) is not None)
+        self.assertTrue(
+            0 < self.redis_client.ttl('observations_wifi_1_lock') <= 300)
+        # only the owner of the lock can release it
+        self.buffer.unlock('wifi', 1, 'other')
+        self.assertTrue(self.buffer.lock('wifi', 1) is None)
+        self.buffer.unlock('wifi', 1, token)
+        self.assertTrue(self.buffer.lock('wifi', 1) is not None)
+
+    def test_drain_locked(self):
+        wifi = dict(key='%012x' % 1, lat=1.0, lon=2.0)
+        self.buffer.push('wifi', [wifi])
+        shard = self.buffer.shard('wifi', wifi)
+        token = self.buffer.lock('wifi', shard)
+        self.assertEqual(drain_observations.delay('wifi', shard).get(), 0)
+        self.assertEqual(self.buffer.lengths('wifi')[shard], 1)
+
+        self.buffer.unlock('wifi', shard, token)
+        self.assertEqual(drain_observations.delay('wifi', shard).get(), 1)
+        self.assertEqual(self.buffer.lengths('wifi')[shard], 0)
+        # the lock was released again
+        self.assertTrue(self.buffer.lock('wifi', shard) is not None)
+
+    def test_disabled(self):
+        celery.observation_buffer = None
+        self.assertEqual(scan_observations.delay('wifi').get(), 0)
+
+
 class TestSubmitErrors(CeleryTestCase):
     # this is a standalone class to ensure DB isolation for dropping tables
 
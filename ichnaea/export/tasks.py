@@ -211,15 +211,8 @@ def import_stations(session, filename, fields):
         batch = 10000
         rows = []
         area_keys = set()
-        ins = OCIDCell.__table__.insert(
-            on_duplicate=((
-                'changeable = values(changeable), '
-                'modified = values(modified), '
-                'total_measures = values(total_measures), '
-                'lat = values(lat), '
-                'lon = values(lon), '
-                'psc = values(psc), '
-                '`range` = values(`range`)')))
+        replace = ('changeable', 'modified', 'total_measures',
+                   'lat', 'lon', 'psc', 'range')
 
         for row in csv_reader:
             # skip any header row
@@ -233,12 +226,14 @@ def import_stations(session, filename, fields):
                 area_keys.add(CellArea.to_hashkey(data))
 
             if len(rows) == batch:  # pragma: no cover
-                session.execute(ins, rows)
+                session.upsert(OCIDCell.__table__, rows, replace=replace,
+                               batch=1000)
                 session.commit()
                 rows = []
 
         if rows:
-            session.execute(ins, rows)
+            session.upsert(OCIDCell.__table__, rows, replace=replace,
+                           batch=1000)
             session.commit()
 
         for area_key in area_keys:
@@ -6,7 +6,8 @@
 worker_class = "ichnaea.gunicorn_worker.LocationGeventWorker"
 
 # Maximum number of simultaneous greenlets,
-# limited by number of DB and Redis connections
+# limited by number of DB and Redis connections.
+# Keep the locate_concurrency_limit setting in sync with this.
 worker_connections = 20
 
 # Set timeout to the same value as the default one from Amazon ELB (60 secs).
@@ -74,6 +74,7 @@ def log_tween_factory(handler, registry):
         '/v1/submit',
         '/v1/search',
         '/v1/geolocate',
+        '/v1/geolocate/batch',
         '/v1/geosubmit',
     ]
 
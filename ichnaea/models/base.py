@@ -37,14 +37,21 @@ class BaseModel(object):
 _Model = declarative_base(cls=BaseModel)
 
 
+# schema instances are stateless and shared by all validate calls
+_VALID_SCHEMAS = {}
+
+
 class ValidationMixin(object):
 
     _valid_schema = None
 
     @classmethod
     def validate(cls, entry, _raise_invalid=False, **kw):
+        schema = _VALID_SCHEMAS.get(cls._valid_schema)
+        if schema is None:
+            schema = _VALID_SCHEMAS[cls._valid_schema] = cls._valid_schema()
         try:
-            validated = cls._valid_schema().deserialize(entry, **kw)
+            validated = schema.deserialize(entry, **kw)
         except colander.Invalid:
             if _raise_invalid:  # pragma: no cover
                 raise
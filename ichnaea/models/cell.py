@@ -62,7 +62,7 @@ class CellHashKey(HashKey):
         return cls(**data)
 
     def _to_json_value(self):
-        value = self.__dict__.copy()
+        value = self._to_dict()
         value['radio'] = int(value['radio'])
         return value
 
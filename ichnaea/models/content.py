@@ -1,12 +1,16 @@
+from weakref import WeakValueDictionary
+
 from enum import IntEnum
 from sqlalchemy import (
     Column,
     Date,
+    event,
     Index,
     Unicode,
     UniqueConstraint,
 )
 from sqlalchemy.dialects.mysql import INTEGER as Integer
+from sqlalchemy.orm import Session
 
 from ichnaea.models.base import (
     _Model,
@@ -73,17 +77,33 @@ class Score(IdMixin, HashKeyMixin, _Model):
 
     @classmethod
     def incr(cls, session, key, value):
-        score = cls.querykey(session, key).first()
-        if score is not None:
-            score.value += int(value)
-        else:
-            stmt = cls.__table__.insert(
-                on_duplicate='value = value + %s' % int(value)).values(
-                userid=key.userid, key=key.key, time=key.time, value=value)
-            session.execute(stmt)
+        session.upsert(cls.__table__, [{
+            'userid': key.userid, 'key': key.key,
+            'time': key.time, 'value': int(value),
+        }], increment=('value', ))
+        # a score already loaded into the session is out of date now
+        obj = _score_index(session).get(key)
+        if obj is not None and obj in session:
+            session.expire(obj, ['value'])
         return value
 
 
+def _score_index(session):
+    # the scores in a session, by hashkey
+    return session.info.setdefault('scores', WeakValueDictionary())
+
+
+@event.listens_for(Score, 'load')
+def _index_loaded_score(target, context):
+    _score_index(context.session)[target.hashkey()] = target
+
+
+@event.listens_for(Session, 'after_attach')
+def _index_attached_score(session, instance):
+    if isinstance(instance, Score):
+        _score_index(session)[instance.hashkey()] = instance
+
+
 class Stat(IdMixin, _Model):
     __tablename__ = 'stat'
 
@@ -1,24 +1,81 @@
+from collections import OrderedDict
+
 from pyramid.path import DottedNameResolver
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql import and_, bindparam, or_, tuple_
 
 RESOLVER = DottedNameResolver('ichnaea')
 
+QUERY_STRATEGIES = frozenset(['or', 'prefix', 'tuple'])
+"""
+Strategies to restrict a query to a list of multi-field hash keys:
+
+- or: ``(a = 1 AND b = 2) OR (a = 1 AND b = 3)``
+- prefix: ``(a = 1 AND b IN (2, 3))``, grouped by all but the last field
+- tuple: ``(a, b) IN ((1, 2), (1, 3))``, only used if a model asks
+  for it, as MySQL before 5.7.3 can't use an index for these
+"""
+
+QUERY_OR_MAX_KEYS = 4
+"""Up to this many keys, an ``OR`` of ``AND`` criteria is used."""
+
+
+def _field_property(index):
+    return property(lambda self: self._values[index])
+
+
+def _unpickle_hashkey(cls, values):
+    return cls._make(values)
+
+
+class HashKeyMeta(type):
+    """
+    Turns the `_fields` of a :class:`HashKey` subclass into read-only
+    properties backed by a single value tuple.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        for i, field in enumerate(attrs.get('_fields', ())):
+            attrs[field] = _field_property(i)
+        return super(HashKeyMeta, mcs).__new__(mcs, name, bases, attrs)
+
 
 class HashKey(object):
+    """
+    An immutable, hashable key for a model. Subclasses list their
+    field names in `_fields`. The values are stored as a single tuple
+    and the hash is computed once on creation.
+    """
 
+    __metaclass__ = HashKeyMeta
+    __slots__ = ('_values', '_hash')
     _fields = ()
 
     def __init__(self, *args, **kw):
-        values = {}
-        for i, value in enumerate(args):  # pragma: no cover
-            values[self._fields[i]] = value
-        for field in self._fields:
-            if field in kw:
-                values[field] = kw[field]
-            else:
-                values[field] = None
-        for key, value in values.items():
-            setattr(self, key, value)
+        values = list(args)
+        for field in self._fields[len(values):]:
+            values.append(kw.get(field))
+        self._set_values(tuple(values))
+
+    def _set_values(self, values):
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_hash', hash(values))
+
+    @classmethod
+    def _make(cls, values):
+        # create a key from a tuple of values in field order,
+        # without going through keyword argument handling
+        key = cls.__new__(cls)
+        key._set_values(tuple(values))
+        return key
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __reduce__(self):
+        # copy and pickle would otherwise try to set the slots
+        # on a new instance and fail on the immutability check
+        return (_unpickle_hashkey, (self.__class__, self._values))
 
     @property
     def _dottedname(self):
@@ -42,32 +99,39 @@ class HashKey(object):
         }}
 
     def _to_json_value(self):
-        return self.__dict__
+        return self._to_dict()
+
+    def _to_dict(self):
+        # not called _asdict, as simplejson would treat us as a namedtuple
+        return dict(zip(self._fields, self._values))
 
     def __eq__(self, other):
         if isinstance(other, HashKey):
-            return self.__dict__ == other.__dict__
+            return (self._hash == other._hash and
+                    self._fields == other._fields and
+                    self._values == other._values)
         return False  # pragma: no cover
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __getitem__(self, key):
         if key in self._fields:
-            return getattr(self, key, None)
+            return self._values[self._fields.index(key)]
         raise IndexError  # pragma: no cover
 
     def __hash__(self):
-        # emulate a tuple hash
-        value = ()
-        for field in self._fields:
-            value += (getattr(self, field, None), )
-        return hash(value)
+        return self._hash
 
     def __repr__(self):
-        return '{cls}: {data}'.format(cls=self._dottedname, data=self.__dict__)
+        return '{cls}: {data}'.format(
+            cls=self._dottedname, data=self._to_dict())
 
 
 class HashKeyMixin(object):
 
     _hashkey_cls = None
+    _query_strategy = None  # one of QUERY_STRATEGIES, None to auto-select
 
     @classmethod
     def _to_hashkey(cls, *args, **kw):
@@ -75,15 +139,17 @@ class HashKeyMixin(object):
             obj = args[0]
         else:
             obj = kw
-        if isinstance(obj, cls._hashkey_cls):
+        key_cls = cls._hashkey_cls
+        if isinstance(obj, key_cls):
             return obj
-        fields = cls._hashkey_cls._fields
+        fields = key_cls._fields
+        if isinstance(obj, HashKey) and \
+                obj._fields[:len(fields)] == fields:
+            # a more specific key, like a CellKey for a CellAreaKey
+            return key_cls._make(obj._values[:len(fields)])
         if isinstance(obj, dict):
-            return cls._hashkey_cls(**obj)
-        values = {}
-        for field in fields:
-            values[field] = getattr(obj, field, None)
-        return cls._hashkey_cls(**values)
+            return key_cls(**obj)
+        return key_cls._make([getattr(obj, field, None) for field in fields])
 
     @classmethod
     def to_hashkey(cls, *args, **kw):
@@ -111,22 +177,141 @@ class HashKeyMixin(object):
         return session.query(cls).filter(*cls.joinkey(key))
 
     @classmethod
-    def querykeys(cls, session, keys):
-        if not keys:  # pragma: no cover
-            # prevent construction of queries without a key restriction
-            raise ValueError('Model.querykeys called with empty keys.')
+    def _query_plan(cls, prefixes, key_count):
+        if cls._query_strategy is not None:
+            return cls._query_strategy
+        if key_count <= QUERY_OR_MAX_KEYS:
+            return 'or'
+        if len(prefixes) * 2 <= key_count:
+            # at least two keys per prefix on average
+            return 'prefix'
+        return 'or'
 
-        if len(cls._hashkey_cls._fields) == 1:
+    @classmethod
+    def joinkeys(cls, keys, strategy=None):
+        fields = cls._hashkey_cls._fields
+        if len(fields) == 1:
             # optimize queries for hashkeys with single fields to use
             # a 'WHERE model.somefield IN (:key_1, :key_2)' query
-            field = cls._hashkey_cls._fields[0]
+            field = fields[0]
             key_list = []
             for key in keys:
                 key_list.append(getattr(key, field))
-            return session.query(cls).filter(getattr(cls, field).in_(key_list))
+            return getattr(cls, field).in_(key_list)
 
         key_filters = []
+        complete = []
+        prefixes = OrderedDict()
+        for key in keys:
+            values = tuple([getattr(key, name, None) for name in fields])
+            if None in values:
+                # partial keys only restrict the query by their known
+                # fields, which neither of the IN strategies support
+                key_filters.append(and_(*cls.joinkey(key)))
+            else:
+                complete.append(values)
+                prefixes.setdefault(values[:-1], []).append(values[-1])
+
+        if not complete:
+            return or_(*key_filters)
+
+        if strategy is None:
+            strategy = cls._query_plan(prefixes, len(complete))
+        if strategy not in QUERY_STRATEGIES:  # pragma: no cover
+            raise ValueError('Unknown query strategy: %r' % strategy)
+
+        columns = [getattr(cls, name) for name in fields]
+        if strategy == 'tuple':
+            key_filters.append(tuple_(*columns).in_(complete))
+        elif strategy == 'prefix':
+            for prefix, last_values in prefixes.items():
+                criterion = [col == value for col, value in
+                             zip(columns[:-1], prefix)]
+                if len(last_values) == 1:
+                    criterion.append(columns[-1] == last_values[0])
+                else:
+                    criterion.append(columns[-1].in_(last_values))
+                key_filters.append(and_(*criterion))
+        else:
+            for values in complete:
+                # create a list of 'and' criteria for each hash key component
+                key_filters.append(and_(*[
+                    col == value for col, value in zip(columns, values)]))
+        return or_(*key_filters)
+
+    @classmethod
+    def joinkeys_shape(cls, keys):
+        """
+        Return the shape of a :meth:`joinkeys_template` criterion for
+        the given keys, as a `(size, strategy)` tuple. The number of keys
+        is rounded up to the next power of two, to limit the number of
+        distinct statements.
+
+        Returns `None` if there are no keys or any of the keys lacks
+        a field value.
+        """
+        if not keys:
+            return None
+        fields = cls._hashkey_cls._fields
         for key in keys:
-            # create a list of 'and' criteria for each hash key component
-            key_filters.append(and_(*cls.joinkey(key)))
-        return session.query(cls).filter(or_(*key_filters))
+            for field in fields:
+                if getattr(key, field, None) is None:
+                    return None
+        size = 1
+        while size < len(keys):
+            size *= 2
+        if len(fields) == 1:
+            strategy = 'in'
+        elif cls._query_strategy == 'tuple':
+            strategy = 'tuple'
+        else:
+            # prefix groups depend on the key values, so they can't
+            # be part of a reusable statement
+            strategy = 'or'
+        return (size, strategy)
+
+    @classmethod
+    def joinkeys_template(cls, shape, prefix):
+        """
+        Return a criterion like :meth:`joinkeys`, for the given
+        :meth:`joinkeys_shape` and with named bind parameters instead of
+        key values. Parameter names start with `prefix`.
+        """
+        size, strategy = shape
+        fields = cls._hashkey_cls._fields
+        columns = [getattr(cls, field) for field in fields]
+        rows = []
+        for i in range(size):
+            rows.append([
+                bindparam('%s_%d_%s' % (prefix, i, field), type_=col.type)
+                for field, col in zip(fields, columns)])
+        if strategy == 'in':
+            return columns[0].in_([row[0] for row in rows])
+        if strategy == 'tuple':
+            return tuple_(*columns).in_([tuple_(*row) for row in rows])
+        return or_(*[and_(*[col == param for col, param in zip(columns, row)])
+                     for row in rows])
+
+    @classmethod
+    def joinkeys_params(cls, keys, shape, prefix):
+        """
+        Return the bind parameters of a :meth:`joinkeys_template`
+        criterion for the given keys. The keys are padded to the size of
+        the shape by repeating the last key.
+        """
+        size = shape[0]
+        keys = list(keys)
+        keys.extend([keys[-1]] * (size - len(keys)))
+        params = {}
+        for i, key in enumerate(keys):
+            for field in cls._hashkey_cls._fields:
+                params['%s_%d_%s' % (prefix, i, field)] = getattr(key, field)
+        return params
+
+    @classmethod
+    def querykeys(cls, session, keys):
+        if not keys:  # pragma: no cover
+            # prevent construction of queries without a key restriction
+            raise ValueError('Model.querykeys called with empty keys.')
+
+        return session.query(cls).filter(cls.joinkeys(keys))
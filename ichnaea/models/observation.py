@@ -140,13 +140,13 @@ class Report(PositionMixin, ValidationMixin):
 class ObservationMixin(CreationMixin, BigIdMixin, Report):
 
     @classmethod
-    def create(cls, _raise_invalid=False, **kw):
-        validated = cls.validate(kw, _raise_invalid=_raise_invalid)
-        if validated is None:  # pragma: no cover
-            return None
-        # BBB: no longer required, internaljson format decodes to datetime
-        validated['time'] = decode_datetime(validated['time'])
-        return cls(**validated)
+    def validate(cls, entry, _raise_invalid=False, **kw):
+        validated = super(ObservationMixin, cls).validate(
+            entry, _raise_invalid=_raise_invalid, **kw)
+        if validated is not None:
+            # BBB: no longer required, internaljson format decodes to datetime
+            validated['time'] = decode_datetime(validated['time'])
+        return validated
 
 
 class ValidCellLookupSchema(ValidCellKeySchema):
@@ -41,6 +41,133 @@ def normalized_time(time):
     return time
 
 
+def _compile_string(node):
+    def deserialize(cstruct):
+        if not cstruct:
+            return colander.null
+        if not isinstance(cstruct, basestring):
+            raise colander.Invalid(node)
+        try:
+            return unicode(cstruct)
+        except Exception:
+            raise colander.Invalid(node)
+    return deserialize
+
+
+def _compile_number(node):
+    num = node.typ.num
+
+    def deserialize(cstruct):
+        if cstruct != 0 and not cstruct:
+            return colander.null
+        try:
+            return num(cstruct)
+        except Exception:
+            raise colander.Invalid(node)
+    return deserialize
+
+
+def _compile_mapping(node):
+    children = [
+        (child.name, compile_node(child), child.default is colander.drop)
+        for child in node.children]
+    null = colander.null
+    drop = colander.drop
+
+    def deserialize(cstruct):
+        if cstruct is null:
+            return null
+        if not hasattr(cstruct, 'items'):
+            raise colander.Invalid(node)
+        try:
+            value = dict(cstruct)
+        except Exception:
+            raise colander.Invalid(node)
+        result = {}
+        for name, child, default_drop in children:
+            subvalue = value.get(name, null)
+            if subvalue is drop or (subvalue is null and default_drop):
+                continue
+            subvalue = child(subvalue)
+            if subvalue is not drop:
+                result[name] = subvalue
+        return result
+    return deserialize
+
+
+def _compile_sequence(node):
+    child = compile_node(node.children[0])
+
+    def deserialize(cstruct):
+        if cstruct is colander.null:
+            return colander.null
+        if (not hasattr(cstruct, '__iter__') or hasattr(cstruct, 'get') or
+                isinstance(cstruct, basestring)):
+            raise colander.Invalid(node)
+        return [child(value) for value in cstruct]
+    return deserialize
+
+
+_TYPE_COMPILERS = {
+    colander.Float: _compile_number,
+    colander.Integer: _compile_number,
+    colander.String: _compile_string,
+    colander.Mapping: _compile_mapping,
+    colander.Sequence: _compile_sequence,
+}
+
+
+def _compilable(node):
+    typ = node.typ
+    if type(typ) not in _TYPE_COMPILERS:
+        return False
+    if isinstance(typ, colander.String) and typ.encoding:
+        return False
+    if isinstance(typ, colander.Mapping) and typ.unknown != 'ignore':
+        return False
+    if isinstance(typ, colander.Sequence) and typ.accept_scalar:
+        return False
+    deserialize = getattr(type(node).deserialize, '__func__', None)
+    return (deserialize is colander.SchemaNode.deserialize.__func__ and
+            node.preparer is None and
+            not isinstance(node.missing, colander.deferred) and
+            not isinstance(node.validator, colander.deferred))
+
+
+def compile_node(node):
+    """
+    Compile a colander schema node into a plain function, which takes
+    a cstruct and returns the same appstruct as `node.deserialize`.
+
+    Only the plain String, Integer, Float, Mapping and Sequence types
+    are compiled. Nodes with other types, preparers, deferred values
+    or their own deserialize method use `node.deserialize` instead.
+
+    The compiled function raises a bare :exc:`colander.Invalid` for
+    any invalid data. Call `node.deserialize` to get the detailed
+    error messages.
+    """
+    if not _compilable(node):
+        return node.deserialize
+
+    deserialize_type = _TYPE_COMPILERS[type(node.typ)](node)
+    missing = node.missing
+    validator = node.validator
+    null = colander.null
+    required = colander.required
+
+    def deserialize(cstruct=null):
+        appstruct = deserialize_type(cstruct)
+        if appstruct is null:
+            if missing is required:
+                raise colander.Invalid(node, 'Required')
+            return missing
+        if validator is not None:
+            validator(node, appstruct)
+        return appstruct
+    return deserialize
+
+
 class DateTimeFromString(colander.DateTime):
     """
     A DateTimeFromString will return a datetime object
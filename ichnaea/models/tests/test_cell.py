@@ -34,6 +34,25 @@ class TestCell(DBTestCase):
         self.assertEqual(result.lon, GB_LON)
         self.assertEqual(result.total_measures, 15)
 
+    def test_querykeys(self):
+        session = self.session
+        keys = []
+        for lac in (1, 2, 3):
+            for cid in (4, 5, 6):
+                cell = Cell.create(
+                    radio=Radio.gsm, mcc=GB_MCC, mnc=GB_MNC, lac=lac, cid=cid,
+                    lat=GB_LAT, lon=GB_LON)
+                session.add(cell)
+                keys.append(cell.hashkey())
+        session.flush()
+
+        wanted = set(keys[1:8])
+        for strategy in (None, 'or', 'prefix', 'tuple'):
+            query = session.query(Cell).filter(
+                Cell.joinkeys(wanted, strategy=strategy))
+            self.assertEqual(
+                set([row.hashkey() for row in query.all()]), wanted)
+
 
 class TestCellArea(DBTestCase):
 
@@ -49,6 +49,25 @@ class TestScore(DBTestCase):
         self.assertEqual(int(result.key), 0)
         self.assertEqual(result.key.name, 'location')
 
+    def test_incr(self):
+        utcday = util.utcnow().date()
+        session = self.session
+        key = Score.to_hashkey(userid=3, key=ScoreKey.location, time=utcday)
+        Score.incr(session, key, 2)
+        score = session.query(Score).first()
+        self.assertEqual(score.value, 2)
+
+        # the loaded score reflects the new value
+        Score.incr(session, key, 3)
+        self.assertEqual(score.value, 5)
+
+        other = Score(key=ScoreKey.new_cell, userid=3, time=utcday, value=1)
+        session.add(other)
+        session.flush()
+        Score.incr(session, other.hashkey(), 1)
+        self.assertEqual(other.value, 2)
+        self.assertEqual(score.value, 5)
+
 
 class TestStat(DBTestCase):
 
@@ -0,0 +1,185 @@
+import copy
+import pickle
+
+from sqlalchemy.dialects import mysql
+
+from ichnaea.customjson import (
+    kombu_dumps,
+    kombu_loads,
+)
+from ichnaea.models.cell import (
+    Cell,
+    CellArea,
+    CellAreaKey,
+    CellKey,
+    CellKeyPsc,
+    Radio,
+)
+from ichnaea.models.observation import CellObservation
+from ichnaea.models.wifi import (
+    Wifi,
+    WifiKey,
+)
+from ichnaea.tests.base import TestCase
+
+
+class TestHashKey(TestCase):
+
+    def test_fields(self):
+        key = CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3)
+        self.assertEqual(key.mcc, 1)
+        self.assertEqual(key.cid, None)
+        self.assertEqual(key['lac'], 3)
+        self.assertEqual(key._to_dict(), {
+            'radio': Radio.gsm, 'mcc': 1, 'mnc': 2, 'lac': 3, 'cid': None})
+
+    def test_slots(self):
+        key = WifiKey(key='3680873e9b83')
+        self.assertFalse(hasattr(key, '__dict__'))
+        self.assertRaises(AttributeError, setattr, key, 'other', 1)
+
+    def test_immutable(self):
+        key = WifiKey(key='3680873e9b83')
+        self.assertRaises(AttributeError, setattr, key, 'key', 'abc')
+        self.assertEqual(key.key, '3680873e9b83')
+
+    def test_positional(self):
+        key = CellAreaKey(Radio.gsm, 1, 2, lac=3)
+        self.assertEqual(
+            key, CellAreaKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3))
+
+    def test_eq_hash(self):
+        key1 = CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4)
+        key2 = CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4)
+        key3 = CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=5)
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+        self.assertEqual(hash(key1), hash(key2))
+        self.assertEqual(len(set([key1, key2, key3])), 2)
+
+    def test_eq_other_fields(self):
+        key = CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4)
+        psc_key = CellKeyPsc(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4)
+        self.assertNotEqual(key, psc_key)
+        self.assertFalse(key == psc_key)
+
+    def test_convert(self):
+        psc_key = CellKeyPsc(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4,
+                             psc=5)
+        key = Cell.to_hashkey(psc_key)
+        self.assertEqual(type(key), CellKey)
+        self.assertEqual(key, CellKey(radio=Radio.gsm, mcc=1, mnc=2,
+                                      lac=3, cid=4))
+        area_key = CellArea.to_hashkey(key)
+        self.assertEqual(type(area_key), CellAreaKey)
+        self.assertEqual(area_key, CellAreaKey(radio=Radio.gsm, mcc=1,
+                                               mnc=2, lac=3))
+        self.assertTrue(Cell.to_hashkey(key) is key)
+
+    def test_convert_object(self):
+        obs = CellObservation(radio=Radio.gsm, mcc=1, mnc=2, lac=3, cid=4)
+        self.assertEqual(obs.hashkey(), CellKeyPsc(radio=Radio.gsm, mcc=1,
+                                                   mnc=2, lac=3, cid=4))
+        self.assertEqual(CellArea.to_hashkey(obs),
+                         CellAreaKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3))
+
+    def test_json(self):
+        keys = [
+            CellAreaKey(radio=Radio.lte, mcc=1, mnc=2, lac=3),
+            CellKey(radio=Radio.umts, mcc=1, mnc=2, lac=3, cid=4),
+            WifiKey(key='3680873e9b83'),
+        ]
+        for key in keys:
+            result = kombu_loads(kombu_dumps(key))
+            self.assertEqual(type(result), type(key))
+            self.assertEqual(result, key)
+
+    def test_copy_pickle(self):
+        keys = [
+            CellAreaKey(radio=Radio.lte, mcc=1, mnc=2, lac=3),
+            CellKeyPsc(radio=Radio.umts, mcc=1, mnc=2, lac=3, cid=4),
+            WifiKey(key='3680873e9b83'),
+        ]
+        for key in keys:
+            for result in (copy.copy(key), copy.deepcopy(key),
+                           pickle.loads(pickle.dumps(key)),
+                           pickle.loads(pickle.dumps(key, 2))):
+                self.assertEqual(type(result), type(key))
+                self.assertEqual(result, key)
+                self.assertEqual(hash(result), hash(key))
+
+
+class TestJoinKeys(TestCase):
+
+    def _sql(self, model, keys, strategy=None):
+        criterion = model.joinkeys(keys, strategy=strategy)
+        return str(criterion.compile(dialect=mysql.dialect()))
+
+    def _keys(self, lacs, cids):
+        return [CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=lac, cid=cid)
+                for lac in lacs for cid in cids]
+
+    def test_single_field(self):
+        sql = self._sql(Wifi, [WifiKey(key='ab'), WifiKey(key='cd')])
+        self.assertEqual(sql, 'wifi.`key` IN (%s, %s)')
+
+    def test_auto_or(self):
+        sql = self._sql(Cell, self._keys([3], [4, 5]))
+        self.assertEqual(sql.count(' OR '), 1)
+        self.assertFalse(' IN ' in sql)
+
+    def test_auto_prefix(self):
+        sql = self._sql(Cell, self._keys([3, 4], [5, 6, 7]))
+        self.assertEqual(sql.count(' OR '), 1)
+        self.assertEqual(sql.count('cell.cid IN (%s, %s, %s)'), 2)
+
+    def test_auto_many_prefixes(self):
+        sql = self._sql(Cell, self._keys([3, 4, 5, 6, 7], [8]))
+        self.assertEqual(sql.count(' OR '), 4)
+        self.assertFalse(' IN ' in sql)
+
+    def test_model_strategy(self):
+        Cell._query_strategy = 'tuple'
+        try:
+            sql = self._sql(Cell, self._keys([3], [4, 5]))
+            shape = Cell.joinkeys_shape(self._keys([3], [4]))
+        finally:
+            del Cell._query_strategy
+        self.assertTrue(sql.startswith(
+            '(cell.radio, cell.mcc, cell.mnc, cell.lac, cell.cid) IN ('))
+        self.assertEqual(shape, (1, 'tuple'))
+
+    def test_explicit(self):
+        keys = self._keys([3], [4, 5])
+        self.assertTrue('cell.cid IN (%s, %s)' in
+                        self._sql(Cell, keys, strategy='prefix'))
+        self.assertTrue(') IN ((' in self._sql(Cell, keys, strategy='tuple'))
+
+    def test_partial_keys(self):
+        keys = self._keys([3, 4], [5, 6, 7])
+        keys.append(CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=9))
+        sql = self._sql(Cell, keys)
+        self.assertEqual(sql.count('cell.cid IN (%s, %s, %s)'), 2)
+        self.assertEqual(sql.count(' OR '), 2)
+        self.assertTrue('cell.cid' not in sql.split(' OR ')[0])
+
+    def test_template_shape(self):
+        self.assertEqual(Cell.joinkeys_shape([]), None)
+        self.assertEqual(Cell.joinkeys_shape(self._keys([3], [4, 5, 6])),
+                         (4, 'or'))
+        self.assertEqual(Cell.joinkeys_shape(self._keys([3], range(5))),
+                         (8, 'or'))
+        self.assertEqual(Wifi.joinkeys_shape([WifiKey(key='ab')]), (1, 'in'))
+        self.assertEqual(Cell.joinkeys_shape(
+            [CellKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3)]), None)
+
+    def test_template_params(self):
+        keys = self._keys([3], [4, 5, 6])
+        shape = Cell.joinkeys_shape(keys)
+        criterion = Cell.joinkeys_template(shape, 'cell')
+        compiled = criterion.compile(dialect=mysql.dialect())
+        self.assertEqual(str(compiled).count(' OR '), 3)
+        params = Cell.joinkeys_params(keys, shape, 'cell')
+        self.assertEqual(set(params.keys()), set(compiled.params.keys()))
+        self.assertEqual(params['cell_2_cid'], 6)
+        self.assertEqual(params['cell_3_cid'], 6)
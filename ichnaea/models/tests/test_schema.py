@@ -1,6 +1,7 @@
 from datetime import timedelta
 import uuid
 
+import colander
 from pytz import UTC
 
 from ichnaea.models import (
@@ -12,7 +13,11 @@ from ichnaea.models import (
     constants,
     ValidCellKeySchema,
 )
-from ichnaea.models.schema import normalized_time
+from ichnaea.models.schema import (
+    compile_node,
+    normalized_time,
+)
+from ichnaea.models.wifi import WifiKeyNode
 from ichnaea.tests.base import TestCase
 from ichnaea.tests.base import (
     FREMONT_LAT, FREMONT_LON, USA_MCC,
@@ -22,6 +27,71 @@ from ichnaea.tests.base import (
 from ichnaea import util
 
 
+class ItemSchema(colander.MappingSchema):
+    key = colander.SchemaNode(colander.String())
+    radio = colander.SchemaNode(
+        colander.String(), validator=colander.OneOf(['gsm']), missing=None)
+    signal = colander.SchemaNode(colander.Integer(), missing=0)
+    accuracy = colander.SchemaNode(colander.Float(), missing=0.0)
+
+
+class ItemsSchema(colander.SequenceSchema):
+    item = ItemSchema()
+
+
+class BatchSchema(colander.MappingSchema):
+    items = ItemsSchema(validator=colander.Length(max=2))
+
+
+class TestCompileNode(TestCase):
+
+    def _check(self, node, cstruct):
+        compiled = compile_node(node)
+        try:
+            expected = node.deserialize(cstruct)
+        except colander.Invalid:
+            self.assertRaises(colander.Invalid, compiled, cstruct)
+        else:
+            self.assertEqual(compiled(cstruct), expected)
+
+    def test_valid(self):
+        schema = BatchSchema()
+        self._check(schema, {'items': []})
+        self._check(schema, {'items': [{'key': 'a'}]})
+        self._check(schema, {'items': [
+            {'key': u'a', 'radio': 'gsm', 'signal': '-10', 'accuracy': 1,
+             'unknown': 1},
+            {'key': 'b', 'radio': '', 'signal': None, 'accuracy': 0}]})
+        self._check(schema, {'items': ({'key': 'a'}, )})
+
+    def test_invalid(self):
+        schema = BatchSchema()
+        self._check(schema, {})
+        self._check(schema, {'items': {}})
+        self._check(schema, {'items': 'abc'})
+        self._check(schema, {'items': [{'key': 'a'}] * 3})
+        self._check(schema, {'items': [{}]})
+        self._check(schema, {'items': [{'key': ''}]})
+        self._check(schema, {'items': [{'key': 1}]})
+        self._check(schema, {'items': [{'key': 'a', 'radio': 'lte'}]})
+        self._check(schema, {'items': [{'key': 'a', 'signal': 'a'}]})
+        self._check(schema, {'items': [{'key': 'a', 'accuracy': []}]})
+        self._check(schema, {'items': [[('key', 'a')]]})
+
+    def test_missing(self):
+        node = ItemSchema(missing=None)
+        self.assertEqual(compile_node(node)(), None)
+        self.assertEqual(compile_node(node)(colander.null), None)
+
+    def test_not_compiled(self):
+        node = WifiKeyNode(colander.String())
+        self.assertEqual(compile_node(node), node.deserialize)
+        node = colander.SchemaNode(colander.DateTime())
+        self.assertEqual(compile_node(node), node.deserialize)
+        node = colander.SchemaNode(colander.Mapping(unknown='raise'))
+        self.assertEqual(compile_node(node), node.deserialize)
+
+
 class ValidationTest(TestCase):
 
     @classmethod
@@ -105,6 +105,12 @@ def monitor_queue_length(self):
         for name in MONITOR_QUEUE_NAMES:
             result[name] = value = redis_client.llen(name)
             stats_client.gauge('queue.' + name, value)
+        buffer = getattr(self.app, 'observation_buffer', None)
+        if buffer is not None:
+            for station_type in ('cell', 'wifi'):
+                name = 'observations_' + station_type
+                result[name] = value = sum(buffer.lengths(station_type))
+                stats_client.gauge('queue.' + name, value)
     except Exception:  # pragma: no cover
         # Log but ignore the exception
         self.raven_client.captureException()
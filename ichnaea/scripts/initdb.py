@@ -40,7 +40,8 @@ def add_users(conn, location_cfg):
 
     creds = {}
     creds['rw'] = _db_creds(ichnaea_section.get('db_master'))
-    creds['ro'] = _db_creds(ichnaea_section.get('db_slave'))
+    # use the credentials of the first read-only replica
+    creds['ro'] = _db_creds(ichnaea_section.get('db_slave').split()[0])
 
     stmt = text("SELECT user FROM mysql.user")
     result = conn.execute(stmt)
@@ -0,0 +1,195 @@
+from collections import defaultdict
+import threading
+import time
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+
+from ichnaea.customjson import kombu_loads
+from ichnaea.data.area import AREA_CHANNEL
+from ichnaea.logging import get_raven_client
+from ichnaea.models import (
+    CellArea,
+    OCIDCellArea,
+)
+
+
+class CellAreaIndex(object):
+    """
+    An in-process index of the positions of all cell areas, keyed by
+    model and `(radio, mcc, mnc, lac)` tuple.
+
+    The index is loaded on first use and reloaded every `refresh`
+    seconds. In between, single areas are reloaded as soon as a
+    message is published to the Redis `cell_area_update` channel.
+
+    If a `session_factory` is given, reloads run in a background
+    thread on their own session. A reload builds a new index, which
+    replaces the old one at once. Until the first load has finished,
+    :meth:`get_many` returns `None` and areas need to be looked up in
+    the database instead.
+    """
+
+    models = (CellArea, OCIDCellArea)
+
+    def __init__(self, refresh=3600, redis_client=None,
+                 session_factory=None, _timer=time.time, _spawn=None):
+        self.refresh = refresh
+        self.areas = {}
+        self.expires = 0
+        self.pending = defaultdict(set)
+        self.reloading = False
+        self.pubsub = None
+        if redis_client is not None:
+            self.pubsub = redis_client.pubsub()
+        self.session_factory = session_factory
+        self._timer = _timer
+        self._spawn = _spawn
+        if _spawn is None:
+            self._spawn = self._spawn_thread
+
+    def _statement(self, model):
+        return select([model.radio, model.mcc, model.mnc, model.lac,
+                       model.lat, model.lon, model.range]).where(
+            model.lat.isnot(None)).where(model.lon.isnot(None))
+
+    def _entry(self, row):
+        return (tuple([int(value) for value in row[:4]]),
+                (row[4], row[5], row[6]))
+
+    def poll_updates(self):
+        """
+        Return a dict mapping models to the keys of all areas which
+        were updated since the last poll, without waiting for updates.
+        """
+        updates = defaultdict(set)
+        if self.pubsub is None:
+            return updates
+        tables = dict([(model.__tablename__, model) for model in self.models])
+        try:
+            if not self.pubsub.subscribed:
+                self.pubsub.subscribe(AREA_CHANNEL)
+            message = self.pubsub.get_message()
+            while message is not None:
+                if message['type'] == 'message':
+                    data = kombu_loads(message['data'])
+                    model = tables.get(data['table'])
+                    if model is not None:
+                        updates[model].add(data['key'])
+                message = self.pubsub.get_message()
+        except RedisError:
+            # reconnect and subscribe again on the next poll, the
+            # periodic reload picks up any missed updates
+            self.pubsub.reset()
+        return updates
+
+    def reload(self, session):
+        # prevent concurrent requests from reloading the index as well
+        self.expires = self._timer() + self.refresh
+        try:
+            areas = {}
+            for model in self.models:
+                rows = session.execute(self._statement(model)).fetchall()
+                areas[model] = dict([self._entry(row) for row in rows])
+        except Exception:
+            self.expires = 0
+            raise
+        self.areas = areas
+
+    def _spawn_thread(self, function):
+        thread = threading.Thread(target=function)
+        thread.daemon = True
+        thread.start()
+
+    def _reload_background(self):
+        try:
+            session = self.session_factory()
+            try:
+                self.reload(session)
+            finally:
+                try:
+                    session.rollback()
+                finally:
+                    session.close()
+        except Exception:
+            get_raven_client().captureException()
+        finally:
+            self.reloading = False
+
+    def update(self, session, model, keys):
+        """
+        Reload the given areas of one model from the database.
+        """
+        stmt = self._statement(model).where(model.joinkeys(keys))
+        found = dict([self._entry(row)
+                      for row in session.execute(stmt).fetchall()])
+        areas = self.areas.get(model)
+        if areas is None:
+            return
+        for key in keys:
+            key = tuple([int(value) for value in key._values])
+            value = found.get(key)
+            if value is None:
+                areas.pop(key, None)
+            else:
+                areas[key] = value
+
+    def prepare(self, session):
+        """
+        Bring the index up to date, before looking up any areas.
+        """
+        for model, keys in self.poll_updates().items():
+            self.pending[model].update(keys)
+
+        if self._timer() >= self.expires and not self.reloading:
+            if self.session_factory is None:
+                self.reload(session)
+                self.pending.clear()
+                return
+            self.reloading = True
+            self.expires = self._timer() + self.refresh
+            self._spawn(self._reload_background)
+
+        # updates received during a reload are applied to the new index
+        if self.pending and not self.reloading:
+            pending, self.pending = self.pending, defaultdict(set)
+            for model, keys in pending.items():
+                self.update(session, model, keys)
+
+    def get_many(self, model, keys):
+        """
+        Look up the areas of one model for the given cell keys.
+
+        Returns a dict mapping the model's hashkey to a
+        `(lat, lon, range)` tuple, only including known areas, or
+        `None` if the areas of the model haven't been loaded yet.
+        """
+        areas = self.areas.get(model)
+        if areas is None:
+            return None
+        found = {}
+        for key in keys:
+            values = key._values[:4]
+            value = areas.get(values)
+            if value is not None:
+                found[model._hashkey_cls._make(values)] = value
+        return found
+
+    def loaded_models(self):
+        """
+        Return the models whose areas are held in the index.
+        """
+        return set(self.areas.keys())
+
+
+def configure_cell_area_index(settings, redis_client=None,
+                              session_factory=None):
+    """
+    Configure a cell area index based on the `cell_area_index_refresh`
+    setting. Returns `None` if no refresh interval was configured.
+    """
+    refresh = int(settings.get('cell_area_index_refresh', 0))
+    if not refresh:
+        return None
+    return CellAreaIndex(refresh=refresh, redis_client=redis_client,
+                         session_factory=session_factory)
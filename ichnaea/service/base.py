@@ -1,15 +1,23 @@
+import atexit
+from collections import defaultdict
 from functools import wraps
+import threading
+import time
 
 from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden
 from redis import ConnectionError
+from redis.exceptions import RedisError
 from sqlalchemy import text
 
+from ichnaea.cache import ExpiringLRUCache
 from ichnaea.customjson import dumps
 from ichnaea.service.error import DAILY_LIMIT
 from ichnaea import util
 
 API_CHECK = text('select maxreq, log, shortname from api_key '
                  'where valid_key = :api_key')
+API_KEYS = text('select valid_key, maxreq, log, shortname from api_key')
+API_KEY_CHANNEL = 'api_key_invalidate'
 
 INVALID_API_KEY = {
     "error": {
@@ -32,18 +40,117 @@ def invalid_api_key_response():
     return result
 
 
-def rate_limit(redis_client, api_key, maxreq=0, expire=86400):
+class ApiKeyCache(object):
+    """
+    An in-process snapshot of the api_key table.
+
+    The snapshot is reloaded after `refresh` seconds, or as soon as an
+    invalidation message is published to the Redis `api_key_invalidate`
+    channel. Keys missing from the snapshot are looked up in the
+    database, and unknown keys are remembered for `invalid_ttl` seconds.
+    """
+
+    def __init__(self, refresh=300, invalid_ttl=300, invalid_size=10000,
+                 redis_client=None, _timer=time.time):
+        self.refresh = refresh
+        self.keys = {}
+        self.invalid = ExpiringLRUCache(
+            maxsize=invalid_size, ttl=invalid_ttl, _timer=_timer)
+        self.expires = 0
+        self.pubsub = None
+        if redis_client is not None:
+            self.pubsub = redis_client.pubsub()
+        self._timer = _timer
+
+    def poll_invalidation(self):
+        """
+        Check for invalidation messages, without waiting for any.
+        """
+        if self.pubsub is None:
+            return
+        try:
+            if not self.pubsub.subscribed:
+                self.pubsub.subscribe(API_KEY_CHANNEL)
+            message = self.pubsub.get_message()
+            while message is not None:
+                if message['type'] == 'message':
+                    self.expires = 0
+                message = self.pubsub.get_message()
+        except RedisError:
+            # reconnect and subscribe again on the next poll
+            self.pubsub.reset()
+
+    def reload(self, session):
+        # prevent concurrent requests from reloading the table as well
+        self.expires = self._timer() + self.refresh
+        try:
+            rows = session.execute(API_KEYS).fetchall()
+        except Exception:
+            self.expires = 0
+            raise
+        self.keys = dict([(row[0], tuple(row[1:])) for row in rows])
+        self.invalid.clear()
+
+    def get(self, session, api_key):
+        """
+        Look up an api key and return a `(maxreq, log, shortname)`
+        tuple, or `None` for an unknown api key.
+        """
+        self.poll_invalidation()
+        if self._timer() >= self.expires:
+            self.reload(session)
+
+        found_key = self.keys.get(api_key)
+        if found_key is not None:
+            return found_key
+        if self.invalid.get(api_key):
+            return None
+
+        found_key = session.execute(
+            API_CHECK.bindparams(api_key=api_key)).fetchone()
+        if found_key is None:
+            self.invalid.set(api_key, True)
+            return None
+        found_key = self.keys[api_key] = tuple(found_key)
+        return found_key
+
+
+def configure_api_key_cache(settings, redis_client=None):
+    """
+    Configure an api key cache based on the `api_key_cache_*` settings.
+    Returns `None` if no refresh interval was configured.
+    """
+    refresh = int(settings.get('api_key_cache_refresh', 0))
+    if not refresh:
+        return None
+    invalid_ttl = int(settings.get('api_key_cache_invalid_ttl', refresh))
+    return ApiKeyCache(refresh=refresh, invalid_ttl=invalid_ttl,
+                       redis_client=redis_client)
+
+
+def invalidate_api_keys(redis_client):
+    """
+    Tell all web workers to reload their api key snapshots.
+    """
+    redis_client.publish(API_KEY_CHANNEL, 'reload')
+
+
+def rate_limit_key(api_key):
+    dstamp = util.utcnow().strftime("%Y%m%d")
+    return "apilimit:%s:%s" % (api_key, dstamp)
+
+
+def rate_limit(redis_client, api_key, maxreq=0, expire=86400, count=1):
     if not maxreq:
         return False
 
-    dstamp = util.utcnow().strftime("%Y%m%d")
-    key = "apilimit:%s:%s" % (api_key, dstamp)
+    key = rate_limit_key(api_key)
 
     try:
         current = redis_client.get(key)
-        if current is None or int(current) < maxreq:
+        if current is None or int(current) + count <= maxreq:
             pipe = redis_client.pipeline()
-            pipe.incr(key, 1)
+            pipe.incr(key, count)
             # Expire keys after 24 hours
             pipe.expire(key, expire)
             pipe.execute()
@@ -54,7 +161,147 @@ def rate_limit(redis_client, api_key, maxreq=0, expire=86400):
     return True
 
 
-def check_api_key(func_name, error_on_invalidkey=True):
+class LocalRateLimiter(object):
+    """
+    A rate limiter counting requests in-process and flushing the counts
+    to the shared `apilimit:<key>:<date>` Redis counters in batches.
+
+    Requests are allowed based on the global counter value as of the
+    last sync plus the local counts since then. The counters are synced
+    at most every `interval` seconds, so all web workers together can
+    exceed a limit by the requests they see during one interval.
+
+    Keys with a `maxreq` below `min_maxreq` are rate limited exactly,
+    with a Redis round trip per request.
+
+    Once :meth:`start` is called, a background thread also syncs the
+    counts every `interval` seconds and a final time on interpreter
+    shutdown, so counts of an idle worker aren't held back.
+    """
+
+    def __init__(self, redis_client, interval=0.5, min_maxreq=1000,
+                 expire=86400, _timer=time.time):
+        self.redis_client = redis_client
+        self.interval = interval
+        self.min_maxreq = min_maxreq
+        self.expire = expire
+        self.pending = defaultdict(int)
+        self.synced = {}
+        self.seen = set()
+        self.last_sync = _timer()
+        self._timer = _timer
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start syncing the counts periodically in a background thread.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the background thread and flush any remaining counts.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.interval * 2)
+            self._thread = None
+        self.sync()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self._timer() - self.last_sync >= self.interval:
+                self.sync()
+
+    def sync(self):
+        """
+        Flush the local counts to Redis and update the global values
+        of all keys seen since the last sync.
+        """
+        with self._lock:
+            self.last_sync = self._timer()
+            pending, self.pending = self.pending, defaultdict(int)
+            keys = list(self.seen | set(pending.keys()))
+            self.seen = set()
+        if not keys:
+            return
+
+        pipe = self.redis_client.pipeline()
+        for key in keys:
+            pipe.incrby(key, pending.get(key, 0))
+            pipe.expire(key, self.expire)
+        try:
+            result = pipe.execute()
+        except RedisError:
+            # keep the counts and try again during the next sync
+            with self._lock:
+                for key, value in pending.items():
+                    self.pending[key] += value
+                self.seen.update(keys)
+            return
+        self.synced = dict(zip(keys, result[::2]))
+
+    def limit(self, api_key, maxreq=0, count=1):
+        """
+        Count the queries for an api key and return `True` if its
+        daily limit was exceeded, or `None` if Redis was unreachable.
+        """
+        if not maxreq:
+            return False
+        if maxreq < self.min_maxreq:
+            return rate_limit(self.redis_client, api_key, maxreq=maxreq,
+                              expire=self.expire, count=count)
+
+        if self._timer() - self.last_sync >= self.interval:
+            self.sync()
+
+        key = rate_limit_key(api_key)
+        if key not in self.synced:
+            try:
+                self.synced[key] = int(self.redis_client.get(key) or 0)
+            except RedisError:
+                return None
+
+        with self._lock:
+            self.seen.add(key)
+            current = self.synced.get(key, 0) + self.pending[key]
+            if current + count > maxreq:
+                return True
+            self.pending[key] += count
+        return False
+
+
+def configure_rate_limiter(settings, redis_client=None):
+    """
+    Configure a local rate limiter based on the `rate_limit_*` settings.
+    Returns `None` if no sync interval was configured.
+    """
+    interval = float(settings.get('rate_limit_sync_interval', 0))
+    if not interval or redis_client is None:
+        return None
+    min_maxreq = int(settings.get('rate_limit_local_min_maxreq', 1000))
+    limiter = LocalRateLimiter(
+        redis_client, interval=interval, min_maxreq=min_maxreq)
+    limiter.start()
+    return limiter
+
+
+def check_api_key(func_name, error_on_invalidkey=True, query_count=None):
+    """
+    Check the api key of a request and apply its daily rate limit.
+
+    :param query_count: An optional callable taking the request and
+        returning the number of queries contained in it. Each query
+        counts against the rate limit. Defaults to one per request.
+    """
     def c(func):
         @wraps(func)
         def closure(request, *args, **kwargs):
@@ -68,9 +315,14 @@ def check_api_key(func_name, error_on_invalidkey=True):
                     return invalid_api_key_response()
 
             session = request.db_ro_session
+            api_key_cache = getattr(request.registry, 'api_key_cache', None)
             try:
-                result = session.execute(API_CHECK.bindparams(api_key=api_key))
-                found_key = result.fetchone()
+                if api_key_cache is not None:
+                    found_key = api_key_cache.get(session, api_key)
+                else:
+                    result = session.execute(
+                        API_CHECK.bindparams(api_key=api_key))
+                    found_key = result.fetchone()
             except Exception:  # pragma: no cover
                 # if we cannot connect to backend DB, skip api key check
                 raven_client.captureException()
@@ -86,9 +338,21 @@ def check_api_key(func_name, error_on_invalidkey=True):
                 request.api_key_log = bool(api_key_log)
                 request.api_key_name = shortname
 
-                stats_client.incr('%s.api_key.%s' % (func_name, shortname))
-                should_limit = rate_limit(request.registry.redis_client,
-                                          api_key, maxreq=maxreq)
+                count = 1
+                if query_count is not None:
+                    count = query_count(request)
+
+                stats_client.incr(
+                    '%s.api_key.%s' % (func_name, shortname), count)
+                rate_limiter = getattr(
+                    request.registry, 'rate_limiter', None)
+                if rate_limiter is not None:
+                    should_limit = rate_limiter.limit(
+                        api_key, maxreq=maxreq, count=count)
+                else:
+                    should_limit = rate_limit(
+                        request.registry.redis_client,
+                        api_key, maxreq=maxreq, count=count)
                 if should_limit:
                     result = HTTPForbidden()
                     result.content_type = 'application/json'
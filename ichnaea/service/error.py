@@ -1,6 +1,6 @@
 import zlib
 
-from colander import Invalid
+from colander import Invalid, null
 from ichnaea.exceptions import BaseJSONError
 from pyramid.httpexceptions import HTTPError
 from pyramid.response import Response
@@ -9,11 +9,18 @@ from ichnaea.customjson import (
     dumps,
     loads,
 )
+from ichnaea.models.schema import compile_node
 
 MSG_EMPTY = 'No JSON body was provided.'
 MSG_GZIP = 'Error decompressing gzip data stream.'
+MSG_TOO_LARGE = 'The request body is too large.'
 MSG_BAD_RADIO = 'Radio fields were not consistent in the cellTower data.'
 
+# maximum size of a request body, after decompression
+MAX_BODY_SIZE = 10 * 1024 * 1024
+# maximum amount of data decompressed at once
+DECOMPRESS_CHUNK_SIZE = 256 * 1024
+
 
 DAILY_LIMIT = dumps({
     "error": {
@@ -57,6 +64,34 @@ class JSONParseError(HTTPError, BaseJSONError):
         self.content_type = 'application/json'
 
 
+class BodyTooLarge(ValueError):
+    pass
+
+
+def gunzip(data, max_size=MAX_BODY_SIZE, chunk_size=DECOMPRESS_CHUNK_SIZE):
+    """
+    Decompress gzip data in chunks of at most `chunk_size` bytes.
+
+    Raises :exc:`BodyTooLarge` as soon as the decompressed data exceeds
+    `max_size` bytes, without decompressing the remaining data.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    size = 0
+    while data:
+        chunk = decompressor.decompress(data, chunk_size)
+        data = decompressor.unconsumed_tail
+        size += len(chunk)
+        if size > max_size:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+    chunk = decompressor.flush()
+    if size + len(chunk) > max_size:  # pragma: no cover
+        raise BodyTooLarge()
+    chunks.append(chunk)
+    return ''.join(chunks)
+
+
 def preprocess_request(request, schema, extra_checks=(), response=JSONError,
                        accept_empty=False):
     body = {}
@@ -65,10 +100,14 @@ def preprocess_request(request, schema, extra_checks=(), response=JSONError,
 
     body = request.body
     if body:
-        if request.headers.get('Content-Encoding') == 'gzip':
+        if len(body) > MAX_BODY_SIZE:
+            errors.append(dict(name=None, description=MSG_TOO_LARGE))
+        elif request.headers.get('Content-Encoding') == 'gzip':
             # handle gzip request bodies
             try:
-                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                body = gunzip(body)
+            except BodyTooLarge:
+                errors.append(dict(name=None, description=MSG_TOO_LARGE))
             except zlib.error:  # pragma: no cover
                 errors.append(dict(name=None, description=MSG_GZIP))
 
@@ -101,7 +140,36 @@ def preprocess_request(request, schema, extra_checks=(), response=JSONError,
     return (validated, errors)
 
 
+_COMPILED_SCHEMAS = {}
+
+
+def compiled_schema(schema):
+    """
+    Return a list of `(name, deserialize)` tuples for the children
+    of a request schema. The compiled functions are cached per schema
+    class, as request schemas don't have any per instance children.
+    """
+    key = type(schema)
+    children = _COMPILED_SCHEMAS.get(key)
+    if children is None:
+        children = _COMPILED_SCHEMAS[key] = [
+            (child.name, compile_node(child)) for child in schema.children]
+    return children
+
+
 def verify_schema(schema, body, errors, validated):
+    if isinstance(body, dict):
+        # fast path, valid data doesn't need the full colander machinery
+        try:
+            result = dict([(name, deserialize(body.get(name, null)))
+                           for name, deserialize in compiled_schema(schema)])
+        except Invalid:
+            pass
+        else:
+            validated.update(result)
+            return
+
+    # collect the detailed error messages
     schema = schema.bind(request=body)
     for attr in schema.children:
         name = attr.name
@@ -3,6 +3,7 @@
 
 from colander import (
     Integer,
+    Length,
     MappingSchema,
     OneOf,
     SchemaNode,
@@ -12,6 +13,9 @@ from colander import (
 
 RADIO_STRINGS = ['gsm', 'cdma', 'wcdma', 'lte']
 
+# maximum number of queries in a single batch request
+MAX_BATCH_QUERIES = 100
+
 
 class CellTowerSchema(MappingSchema):
     # required
@@ -57,3 +61,12 @@ class GeoLocateSchema(MappingSchema):
     carrier = SchemaNode(String(), missing='')
     cellTowers = CellTowersSchema(missing=())
     wifiAccessPoints = WifiAccessPointsSchema(missing=())
+
+
+class GeoLocateListSchema(SequenceSchema):
+    query = GeoLocateSchema()
+
+
+class GeoLocateBatchSchema(MappingSchema):
+    items = GeoLocateListSchema(
+        validator=Length(min=1, max=MAX_BATCH_QUERIES))
@@ -393,6 +393,97 @@ class TestGeolocateFxOSWorkarounds(AppTestCase):
         self.assertEqual(res.json['accuracy'], cell.range)
 
 
+class TestGeolocateBatch(AppTestCase):
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.url = '/v1/geolocate/batch'
+        self.metric = 'geolocate'
+        self.metric_url = 'request.v1.geolocate.batch'
+
+    def test_ok(self):
+        cell = CellFactory()
+        wifi = WifiFactory()
+        wifis = [wifi, WifiFactory(lat=wifi.lat + 0.0001)]
+        self.session.flush()
+        cell_query = {
+            "cellTowers": [{
+                "radioType": cell.radio.name,
+                "mobileCountryCode": cell.mcc,
+                "mobileNetworkCode": cell.mnc,
+                "locationAreaCode": cell.lac,
+                "cellId": cell.cid},
+            ]}
+
+        res = self.app.post_json(
+            '%s?key=test' % self.url, {"items": [
+                cell_query,
+                {"wifiAccessPoints": [
+                    {"macAddress": wifis[0].key},
+                    {"macAddress": wifis[1].key},
+                ]},
+                {"wifiAccessPoints": [
+                    {"macAddress": wifis[0].key},
+                    {"macAddress": "a82066000000"},
+                ]},
+                cell_query,
+            ]},
+            status=200)
+
+        self.check_stats(
+            counter=[self.metric_url + '.200',
+                     (self.metric + '.api_key.test', 1, 4),
+                     (self.metric + '.api_log.test.cell_hit', 2),
+                     (self.metric + '.api_log.test.wifi_hit', 1),
+                     (self.metric + '.api_log.test.wifi_miss', 1)]
+        )
+        cell_result = {"location": {"lat": cell.lat, "lng": cell.lon},
+                       "accuracy": cell.range}
+        items = res.json['items']
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[0], cell_result)
+        self.assertEqual(items[1], {"location": {"lat": wifi.lat + 0.00005,
+                                                 "lng": wifi.lon},
+                                    "accuracy": wifi.range})
+        self.assertEqual(items[2]['error']['code'], 404)
+        self.assertEqual(items[3], cell_result)
+
+    def test_empty_batch(self):
+        res = self.app.post_json(
+            '%s?key=test' % self.url, {"items": []}, status=400)
+        self.assertEqual(res.json['error']['code'], 400)
+        self.assertEqual(res.json['error']['message'], 'Parse Error')
+
+    def test_parse_error(self):
+        res = self.app.post(
+            '%s?key=test' % self.url, 'not json', status=400)
+        self.assertEqual(res.json['error']['message'], 'Parse Error')
+
+    def test_no_api_key(self):
+        res = self.app.post_json(
+            self.url, {"items": [{}]}, status=400)
+        self.assertEqual(u'Invalid API key', res.json['error']['message'])
+        self.check_stats(counter=[self.metric + '.no_api_key'])
+
+    def test_api_key_limit_counts_queries(self):
+        api_key = uuid1().hex
+        self.session.add(ApiKey(valid_key=api_key, maxreq=5, shortname='dis'))
+        self.session.flush()
+
+        dstamp = util.utcnow().strftime("%Y%m%d")
+        key = "apilimit:%s:%s" % (api_key, dstamp)
+        self.redis_client.incr(key, 3)
+
+        res = self.app.post_json(
+            '%s?key=%s' % (self.url, api_key),
+            {"items": [{}, {}, {}]},
+            status=403)
+
+        errors = res.json['error']['errors']
+        self.assertEqual(errors[0]['reason'], 'dailyLimitExceeded')
+        self.assertEqual(int(self.redis_client.get(key)), 3)
+
+
 class TestGeolocateErrors(AppTestCase):
     # this is a standalone class to ensure DB isolation for dropping tables
 
@@ -1,19 +1,22 @@
 from pyramid.httpexceptions import HTTPNotFound
 
 from ichnaea.customjson import dumps
-from ichnaea.service.geolocate.schema import GeoLocateSchema
+from ichnaea.service.geolocate.schema import (
+    GeoLocateBatchSchema,
+    GeoLocateSchema,
+)
 from ichnaea.service.error import (
     JSONParseError,
     preprocess_request,
 )
 from ichnaea.service.base import check_api_key
 from ichnaea.service.locate import (
-    PositionSearcher,
     map_data,
+    position_searcher,
 )
 
 
-NOT_FOUND = {
+NOT_FOUND_RESULT = {
     "error": {
         "errors": [{
             "domain": "geolocation",
@@ -24,12 +27,25 @@ NOT_FOUND = {
         "message": "Not found",
     }
 }
-NOT_FOUND = dumps(NOT_FOUND)
+NOT_FOUND = dumps(NOT_FOUND_RESULT)
 
 
 def configure_geolocate(config):
     config.add_route('v1_geolocate', '/v1/geolocate')
     config.add_view(geolocate_view, route_name='v1_geolocate', renderer='json')
+    config.add_route('v1_geolocate_batch', '/v1/geolocate/batch')
+    config.add_view(geolocate_batch_view, route_name='v1_geolocate_batch',
+                    renderer='json')
+
+
+def prepare_result(result):
+    return {
+        "location": {
+            "lat": result['lat'],
+            "lng": result['lon'],
+        },
+        "accuracy": float(result['accuracy']),
+    }
 
 
 @check_api_key('geolocate')
@@ -43,13 +59,7 @@ def geolocate_view(request):
     )
 
     data = map_data(data, client_addr=request.client_addr)
-    session = request.db_ro_session
-    result = PositionSearcher(
-        {'geoip': request.registry.geoip_db, 'session': session},
-        api_key_log=getattr(request, 'api_key_log', False),
-        api_key_name=getattr(request, 'api_key_name', None),
-        api_name='geolocate',
-    ).search(data)
+    result = position_searcher(request, 'geolocate').search(data)
 
     if not result:
         result = HTTPNotFound()
@@ -57,10 +67,38 @@ def geolocate_view(request):
         result.body = NOT_FOUND
         return result
 
-    return {
-        "location": {
-            "lat": result['lat'],
-            "lng": result['lon'],
-        },
-        "accuracy": float(result['accuracy']),
-    }
+    return prepare_result(result)
+
+
+def preprocess_batch(request):
+    # the batch is parsed by the api key check, after the key lookup,
+    # to count its queries, and reused by the view
+    data = getattr(request, '_geolocate_batch', None)
+    if data is None:
+        data, errors = preprocess_request(
+            request,
+            schema=GeoLocateBatchSchema(),
+            response=JSONParseError,
+        )
+        request._geolocate_batch = data
+    return data
+
+
+def batch_query_count(request):
+    return len(preprocess_batch(request)['items'])
+
+
+@check_api_key('geolocate', query_count=batch_query_count)
+def geolocate_batch_view(request):
+    data = preprocess_batch(request)
+    queries = [map_data(query, client_addr=request.client_addr)
+               for query in data['items']]
+    results = position_searcher(request, 'geolocate').search_batch(queries)
+
+    items = []
+    for result in results:
+        if result:
+            items.append(prepare_result(result))
+        else:
+            items.append(NOT_FOUND_RESULT)
+    return {'items': items}
@@ -1,10 +1,17 @@
 from collections import defaultdict, deque, namedtuple
 from enum import IntEnum
 from functools import partial
+import hashlib
+from itertools import combinations
 import operator
 
 import mobile_codes
-from sqlalchemy.orm import load_only
+from sqlalchemy.sql import (
+    literal,
+    null,
+    select,
+    union_all,
+)
 
 from ichnaea.constants import (
     CELL_MIN_ACCURACY,
@@ -34,6 +41,10 @@ MAX_WIFI_CLUSTER_KM = 0.5
 MIN_WIFIS_IN_QUERY = 2
 MIN_WIFIS_IN_CLUSTER = 2
 MAX_WIFIS_IN_CLUSTER = 5
+MAX_BSSID_DIFFERENCE = 2
+
+# number of set bits for each byte value
+POPCOUNT = tuple([bin(i).count('1') for i in range(256)])
 
 # helper class used in searching
 Network = namedtuple('Network', ['key', 'lat', 'lon', 'range'])
@@ -66,6 +77,140 @@ def estimate_accuracy(lat, lon, points, minimum):
     return max(accuracy, minimum)
 
 
+def _stations_statement(models, criteria):
+    fields = []
+    for model in models:
+        for field in model._hashkey_cls._fields:
+            if field not in fields:
+                fields.append(field)
+
+    selects = []
+    for model, criterion in zip(models, criteria):
+        table = model.__table__
+        columns = [literal(model.__tablename__).label('source')]
+        for field in fields:
+            if field in model._hashkey_cls._fields:
+                columns.append(table.c[field])
+            else:
+                columns.append(null().label(field))
+        columns.extend([table.c.lat, table.c.lon, table.c.range])
+        selects.append(
+            select(columns).where(criterion)
+                           .where(table.c.lat.isnot(None))
+                           .where(table.c.lon.isnot(None)))
+
+    if len(selects) == 1:
+        return selects[0]
+    return union_all(*selects)
+
+
+def query_stations(session, model_keys):
+    """
+    Query multiple station models for their positions in a single
+    database round trip, using a `UNION ALL` of one select per model.
+
+    :param model_keys: A dict mapping station models to a collection
+        of hashkeys for that model.
+
+    :returns: A dict mapping each model to a dict of hashkeys to
+        (lat, lon, range) tuples. Unknown stations and stations without
+        a position are included with a `None` value.
+    """
+    # Order the models by their number of key fields, so the first select
+    # of the union defines the column types of the entire result.
+    models = sorted(model_keys.keys(), key=lambda model: (
+        -len(model._hashkey_cls._fields), model.__tablename__))
+
+    shapes = [model.joinkeys_shape(model_keys[model]) for model in models]
+    if None in shapes:
+        # keys with missing fields can't use a reusable statement
+        stmt = _stations_statement(
+            models, [model.joinkeys(model_keys[model]) for model in models])
+        rows = session.execute(stmt).fetchall()
+    else:
+        params = {}
+        for model, shape in zip(models, shapes):
+            params.update(model.joinkeys_params(
+                model_keys[model], shape, model.__tablename__))
+
+        def factory():
+            return _stations_statement(models, [
+                model.joinkeys_template(shape, model.__tablename__)
+                for model, shape in zip(models, shapes)])
+
+        statement_shape = ('query_stations', ) + tuple(
+            [(model.__tablename__, shape)
+             for model, shape in zip(models, shapes)])
+        rows = session.execute_cached(
+            statement_shape, factory, params).fetchall()
+
+    result = {}
+    tables = {}
+    for model in models:
+        result[model] = dict([(key, None) for key in model_keys[model]])
+        tables[model.__tablename__] = model
+
+    for row in rows:
+        model = tables[row['source']]
+        key = model._hashkey_cls(**dict(
+            [(field, row[field]) for field in model._hashkey_cls._fields]))
+        result[model][key] = (row['lat'], row['lon'], row['range'])
+
+    return result
+
+
+# a locate query with validated and normalized entries, shared by all
+# providers: geoip is the client address, cell a list of cell hashkeys
+# and wifi a dict mapping wifi keys to their signal strength
+Query = namedtuple('Query', ['geoip', 'cell', 'wifi'])
+
+
+def clean_query(data):
+    """
+    Validate the cell and wifi entries of a search API dictionary
+    once and return a :class:`Query`.
+    """
+    radio = data.get('radio')
+    cell_keys = []
+    for cell in data.get('cell', ()):
+        cell = CellLookup.validate(cell, default_radio=radio)
+        if cell:
+            cell_keys.append(CellLookup.to_hashkey(cell))
+
+    # Estimate signal strength at -100 dBm if none is provided,
+    # which is worse than the 99th percentile of wifi dBms we
+    # see in practice (-98).
+    wifi_signals = {}
+    for wifi in data.get('wifi', ()):
+        wifi = WifiLookup.validate(wifi)
+        if wifi:
+            wifi_signals[wifi['key']] = wifi['signal'] or -100
+
+    return Query(geoip=data.get('geoip'), cell=cell_keys, wifi=wifi_signals)
+
+
+def query_fingerprint(query):
+    """
+    Return a fingerprint of the cell and wifi keys of a :class:`Query`,
+    or `None` if the query contains neither.
+
+    The fingerprint doesn't depend on the order of the keys, the wifi
+    signal strengths or the GeoIP client address.
+    """
+    if not query.cell and not query.wifi:
+        return None
+    cells = set()
+    for key in query.cell:
+        cells.add(':'.join([
+            str(int(value)) if value is not None else ''
+            for value in key._values]))
+    data = '|'.join([
+        ','.join(sorted(cells)),
+        ','.join(sorted(query.wifi)),
+    ])
+    return hashlib.sha1(data).hexdigest()
+
+
 def map_data(data, client_addr=None):
     """
     Transform a geolocate API dictionary to an equivalent search API
@@ -109,6 +254,9 @@ def map_data(data, client_addr=None):
 class AbstractLocation(object):
     """A location returned by a location provider."""
 
+    __slots__ = ('source', 'lat', 'lon', 'accuracy',
+                 'country_code', 'country_name', 'query_data')
+
     def __init__(self, source=None,
                  lat=None, lon=None, accuracy=None,
                  country_code=None, country_name=None, query_data=True):
@@ -145,6 +293,8 @@ class AbstractLocation(object):
 class PositionLocation(AbstractLocation):
     """The location returned by a position query."""
 
+    __slots__ = ()
+
     def found(self):
         return None not in (self.lat, self.lon)
 
@@ -176,6 +326,8 @@ class PositionLocation(AbstractLocation):
 class CountryLocation(AbstractLocation):
     """The location returned by a country query."""
 
+    __slots__ = ()
+
     def found(self):
         return None not in (self.country_code,  self.country_name)
 
@@ -197,6 +349,125 @@ class CountryLocation(AbstractLocation):
         return False  # pragma: no cover
 
 
+class PrefetchedStations(object):
+    """
+    A request local station cache holding the stations looked up for
+    all queries of a batch request. Hits and misses aren't counted,
+    as they were already counted when looking up the batch.
+    """
+
+    log_stats = False
+
+    def __init__(self, stations):
+        self.stations = stations
+
+    def get_many(self, namespace, keys):
+        values = self.stations.get(namespace, {})
+        found = {}
+        missing = []
+        for key in keys:
+            if key in values:
+                found[key] = values[key]
+            else:
+                missing.append(key)
+        return (found, missing)
+
+    def set_many(self, namespace, values):
+        self.stations.setdefault(namespace, {}).update(values)
+
+
+class ConcurrentLookups(object):
+    """
+    Runs the station lookups of a request concurrently, each on its
+    own database session and in its own greenlet.
+
+    At most `per_request` lookups of a request run concurrently. In
+    addition the number of extra greenlets of all requests of a worker
+    process is limited to `limit`. A lookup only gets its own greenlet
+    if a database connection can be checked out for it right away, it
+    never waits for the connection pool. Otherwise lookups run
+    sequentially in the request's greenlet.
+
+    `max_overflow` has to match the connection pool configuration,
+    a negative value means the pool can always open new connections.
+    """
+
+    def __init__(self, session_factory, per_request=2, limit=20,
+                 max_overflow=10):
+        from gevent.lock import BoundedSemaphore
+        self.session_factory = session_factory
+        self.per_request = per_request
+        self.max_overflow = max_overflow
+        self.semaphore = BoundedSemaphore(limit)
+
+    def _checkout(self):
+        # Return a session with a checked out connection, or None if
+        # the pool has neither an idle connection nor room for a new one.
+        session = self.session_factory()
+        pool = session.bind.pool
+        if (self.max_overflow < 0 or pool.checkedin() > 0 or
+                pool.overflow() < self.max_overflow):
+            try:
+                session.connection()
+                return session
+            except Exception:
+                session.close()
+                raise
+        session.close()
+        return None
+
+    def _spawned(self, function, session):
+        try:
+            return function(session=session)
+        finally:
+            try:
+                session.rollback()
+            finally:
+                session.close()
+                self.semaphore.release()
+
+    def run(self, functions):
+        """
+        Call all functions, passing a `session` keyword argument to the
+        functions run in their own greenlet.
+        """
+        import gevent
+        greenlets = []
+        inline = list(functions[:1])
+        for function in functions[1:]:
+            session = None
+            if (len(greenlets) + 1 < self.per_request and
+                    self.semaphore.acquire(blocking=False)):
+                try:
+                    session = self._checkout()
+                finally:
+                    if session is None:
+                        self.semaphore.release()
+            if session is not None:
+                greenlets.append(
+                    gevent.spawn(self._spawned, function, session))
+            else:
+                inline.append(function)
+        for function in inline:
+            function()
+        gevent.joinall(greenlets, raise_error=True)
+
+
+def configure_concurrent_lookups(settings, session_factory, max_overflow=10):
+    """
+    Configure concurrent station lookups based on the
+    `locate_concurrency` and `locate_concurrency_limit` settings.
+    Returns `None` if no per request concurrency was configured.
+    """
+    per_request = int(settings.get('locate_concurrency', 1))
+    if per_request < 2:
+        return None
+    limit = int(settings.get('locate_concurrency_limit', 20))
+    return ConcurrentLookups(
+        session_factory, per_request=per_request, limit=limit,
+        max_overflow=max_overflow)
+
+
 class StatsLogger(object):
 
     def __init__(self, api_key_name, api_key_log, api_name):
@@ -219,23 +490,27 @@ class StatsLogger(object):
         self.raven_client = get_raven_client()
         self.stats_client = get_stats_client()
 
-    def stat_count(self, stat):
+    def stat_count(self, stat, count=1):
         self.stats_client.incr('{api}.{stat}'.format(
-            api=self.api_name, stat=stat))
+            api=self.api_name, stat=stat), count)
 
     def stat_time(self, stat, count):
         self.stats_client.timing('{api}.{stat}'.format(
             api=self.api_name, stat=stat), count)
 
 
-class AbstractLocationProvider(StatsLogger):
+class AbstractLocationProvider(object):
     """
     An AbstractLocationProvider provides an interface for a class
     which will provide a location given a set of query data.
 
+    Providers don't hold any request specific state and are shared
+    between all requests. The request specific state is kept by the
+    :class:`AbstractLocationSearcher` passed into :meth:`locate`.
+
     .. attribute:: data_field
 
-        The key to look for in the query data, for example 'cell'
+        The :class:`Query` field to look at, for example 'cell'
 
     .. attribute:: log_name
 
@@ -247,46 +522,44 @@ class AbstractLocationProvider(StatsLogger):
         cell and cell location area providers.
     """
 
-    db_source_field = 'session'
     data_field = None
     log_name = None
     log_group = None
     location_type = None
     source = DataSource.Internal
 
-    def __init__(self, db_source, *args, **kwargs):
-        self.db_source = db_source
+    def __init__(self):
         self.location_type = partial(self.location_type, source=self.source)
-        super(AbstractLocationProvider, self).__init__(*args, **kwargs)
 
-    def locate(self, data):  # pragma: no cover
-        """Provide a location given the provided query data (dict).
+    def locate(self, query, searcher):  # pragma: no cover
+        """Provide a location given the provided :class:`Query`.
 
+        :param searcher: The searcher of the current request.
         :rtype: :class:`~ichnaea.service.locate.AbstractLocation`
         """
         raise NotImplementedError()
 
-    def log_hit(self):
+    def log_hit(self, searcher):
         """Log a stat metric for a successful provider lookup."""
-        self.stat_count('{metric}_hit'.format(metric=self.log_name))
+        searcher.stat_count('{metric}_hit'.format(metric=self.log_name))
 
-    def log_success(self):
+    def log_success(self, searcher):
         """
         Log a stat metric for a request in which the user provided
         relevant data for this provider and the lookup was successful.
         """
-        if self.api_key_log:
-            self.stat_count('api_log.{key}.{metric}_hit'.format(
-                key=self.api_key_name, metric=self.log_name))
+        if searcher.api_key_log:
+            searcher.stat_count('api_log.{key}.{metric}_hit'.format(
+                key=searcher.api_key_name, metric=self.log_name))
 
-    def log_failure(self):
+    def log_failure(self, searcher):
         """
         Log a stat metric for a request in which the user provided
         relevant data for this provider and the lookup failed.
         """
-        if self.api_key_log:
-            self.stat_count('api_log.{key}.{metric}_miss'.format(
-                key=self.api_key_name, metric=self.log_name))
+        if searcher.api_key_log:
+            searcher.stat_count('api_log.{key}.{metric}_miss'.format(
+                key=searcher.api_key_name, metric=self.log_name))
 
 
 class AbstractCellLocationProvider(AbstractLocationProvider):
@@ -306,45 +579,21 @@ class AbstractCellLocationProvider(AbstractLocationProvider):
     log_group = 'cell'
     location_type = PositionLocation
 
-    def clean_cell_keys(self, data):
-        """Pre-process cell data."""
-        radio = data.get('radio')
-        cell_keys = []
-        for cell in data.get(self.data_field, ()):
-            cell = CellLookup.validate(cell, default_radio=radio)
-            if cell:
-                cell_key = CellLookup.to_hashkey(cell)
-                cell_keys.append(cell_key)
-
-        return cell_keys
-
-    def query_database(self, cell_keys):
-        """Query all cell models."""
+    def query_database(self, cell_keys, stations):
+        """
+        Combine the stations of all cell models, as looked up by
+        :meth:`AbstractLocationSearcher.prefetch_cells`.
+        """
         queried_objects = []
         for model in self.models:
-            found_cells = []
-
-            load_fields = (
-                'radio', 'mcc', 'mnc', 'lac', 'lat', 'lon', 'range')
-
-            if cell_keys:
-                # only do a query if we have cell locations, or this will match
-                # all rows in the table
-                query = (model.querykeys(self.db_source, cell_keys)
-                              .options(load_only(*load_fields))
-                              .filter(model.lat.isnot(None))
-                              .filter(model.lon.isnot(None)))
-
-                try:
-                    found_cells.extend(query.all())
-                except Exception:
-                    self.raven_client.captureException()
+            found_cells = stations.get(model, ())
 
             if found_cells:
                 # Group all found_cellss by location area
                 lacs = defaultdict(list)
                 for cell in found_cells:
-                    cellarea_key = (cell.radio, cell.mcc, cell.mnc, cell.lac)
+                    cellarea_key = (cell.key.radio, cell.key.mcc,
+                                    cell.key.mnc, cell.key.lac)
                     lacs[cellarea_key].append(cell)
 
                 def sort_lac(v):
@@ -383,12 +632,13 @@ class AbstractCellLocationProvider(AbstractLocationProvider):
             avg_lat, avg_lon, queried_objects, CELL_MIN_ACCURACY)
         return self.location_type(lat=avg_lat, lon=avg_lon, accuracy=accuracy)
 
-    def locate(self, data):
+    def locate(self, query, searcher):
         location = self.location_type(query_data=False)
-        cell_keys = self.clean_cell_keys(data)
+        cell_keys = query.cell
         if cell_keys:
             location.query_data = True
-        queried_objects = self.query_database(cell_keys)
+        queried_objects = self.query_database(
+            cell_keys, searcher.prefetched_cells or {})
         if queried_objects:
             location = self.prepare_location(queried_objects)
         return location
@@ -446,7 +696,7 @@ class CellCountryProvider(AbstractCellLocationProvider):
     """
     location_type = CountryLocation
 
-    def query_database(self, cell_keys):
+    def query_database(self, cell_keys, stations):
         countries = []
         for key in cell_keys:
             countries.extend(mobile_codes.mcc(str(key.mcc)))
@@ -472,7 +722,7 @@ class WifiLocationProvider(AbstractLocationProvider):
 
     def cluster_elements(self, items, distance_fn, threshold):
         """
-        Generic pairwise clustering routine.
+        Generic pairwise single-linkage clustering routine.
 
         :param items: A list of elements to cluster.
         :param distance_fn: A pairwise distance_fnance function over elements.
@@ -482,112 +732,123 @@ class WifiLocationProvider(AbstractLocationProvider):
                           for any a in P, b in Q.
 
         :returns: A list of lists of elements, each sub-list being a cluster.
+                  The clusters are ordered by their first element and
+                  each cluster retains the order of the items list.
+        """
+        # Find the connected components of the graph of all elements
+        # within the threshold distance of each other, using a
+        # union-find structure in which the smallest index is the root.
+        parents = list(range(len(items)))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i in range(len(items)):
+            for j in range(i + 1, len(items)):
+                root_i = find(i)
+                root_j = find(j)
+                # skip the distance calculation for already joined elements
+                if (root_i != root_j and
+                        distance_fn(items[i], items[j]) <= threshold):
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+
+        clusters = defaultdict(list)
+        for i, item in enumerate(items):
+            clusters[find(i)].append(item)
+        return [clusters[root] for root in sorted(clusters.keys())]
+
+    def similar_bssids(self, bs):
         """
-        distance_matrix = [[distance_fn(a, b) for a in items] for b in items]
-        clusters = [[i] for i in range(len(items))]
+        Find all pairs of similar BSSIDs. The difference of two BSSIDs
+        is the sum of the per-byte differences, where each byte differs
+        by the smaller one of its arithmetic or hamming distance.
 
-        def cluster_distance(a, b):
-            return min([distance_matrix[i][j] for i in a for j in b])
+        Two BSSIDs with a difference of at most MAX_BSSID_DIFFERENCE can
+        differ in at most that many bytes. So only BSSIDs which are equal
+        after masking out the same combination of bytes are compared,
+        instead of comparing all pairs of BSSIDs.
 
-        merged_one = True
-        while merged_one:
-            merged_one = False
-            for i in range(len(clusters)):
-                if merged_one:
-                    break
-                for j in range(len(clusters)):
-                    if merged_one:
-                        break
-                    if i == j:
+        :returns: A dict mapping each BSSID to the set of BSSIDs
+                  similar to it.
+        """
+        values = {}
+        for key in bs:
+            values[key] = int(key, 16)
+
+        candidates = defaultdict(list)
+        for positions in combinations(range(6), MAX_BSSID_DIFFERENCE):
+            mask = 0xffffffffffff
+            for pos in positions:
+                mask ^= 0xff << (8 * pos)
+            for key, value in values.items():
+                candidates[(positions, value & mask)].append(key)
+
+        similar = defaultdict(set)
+        for group in candidates.values():
+            for i, a in enumerate(group):
+                for b in group[i + 1:]:
+                    if b in similar[a]:
                         continue
-                    a = clusters[i]
-                    b = clusters[j]
-                    if cluster_distance(a, b) <= threshold:
-                        clusters.pop(j)
-                        a.extend(b)
-                        merged_one = True
-
-        return [[items[i] for i in c] for c in clusters]
-
-    def filter_bssids_by_similarity(self, bs):
+                    x = values[a]
+                    y = values[b]
+                    difference = 0
+                    while (x or y) and difference <= MAX_BSSID_DIFFERENCE:
+                        byte_x = x & 0xff
+                        byte_y = y & 0xff
+                        difference += min(abs(byte_x - byte_y),
+                                          POPCOUNT[byte_x ^ byte_y])
+                        x >>= 8
+                        y >>= 8
+                    if difference <= MAX_BSSID_DIFFERENCE:
+                        similar[a].add(b)
+                        similar[b].add(a)
+        return similar
+
+    def filter_bssids_by_similarity(self, bs, similar=None):
         """
         Cluster BSSIDs by "similarity" (hamming or arithmetic distance);
         return one BSSID from each cluster. The distance threshold is
         hard-wired to 2, meaning that two BSSIDs are clustered together
         if they are within a numeric difference of 2 of one another or
         a hamming distance of 2.
-        """
-
-        DISTANCE_THRESHOLD = 2
-
-        def bytes_of_hex_string(hs):
-            return [int(hs[i:i + 2], 16) for i in range(0, len(hs), 2)]
-
-        def hamming_distance(a, b):
-            h = 0
-            v = a ^ b
-            while v:
-                h += 1
-                v &= v - 1
-            return h
-
-        def hamming_or_arithmetic_byte_difference(a, b):
-            return min(abs(a - b), hamming_distance(a, b))
-
-        def bssid_difference(a, b):
-            abytes = bytes_of_hex_string(a)
-            bbytes = bytes_of_hex_string(b)
-            return sum(hamming_or_arithmetic_byte_difference(a, b) for
-                       (a, b) in zip(abytes, bbytes))
-
-        clusters = self.cluster_elements(
-            bs, bssid_difference, DISTANCE_THRESHOLD)
-        return [c[0] for c in clusters]
 
-    def get_clean_wifi_keys(self, data):
-        wifis = []
-
-        # Pre-process wifi data
-        for wifi in data.get(self.data_field, ()):
-            wifi = WifiLookup.validate(wifi)
-            if wifi:
-                wifis.append(wifi)
-
-        # Estimate signal strength at -100 dBm if none is provided,
-        # which is worse than the 99th percentile of wifi dBms we
-        # see in practice (-98).
-
-        wifi_signals = dict([(w['key'], w['signal'] or -100) for w in wifis])
-        wifi_keys = set(wifi_signals.keys())
-
-        return (wifis, wifi_signals, wifi_keys)
-
-    def query_database(self, wifi_keys):
-        queried_wifis = []
-        if len(wifi_keys) >= MIN_WIFIS_IN_QUERY:
-            keys = [Wifi.to_hashkey(key=key) for key in wifi_keys]
-            try:
-                load_fields = ('key', 'lat', 'lon', 'range')
-                query = (Wifi.querykeys(self.db_source, keys)
-                             .options(load_only(*load_fields))
-                             .filter(Wifi.lat.isnot(None))
-                             .filter(Wifi.lon.isnot(None)))
-                queried_wifis = query.all()
-            except Exception:
-                self.raven_client.captureException()
-
-        return queried_wifis
-
-    def get_clusters(self, wifi_signals, queried_wifis):
+        The similar BSSIDs can be passed in, if they have already been
+        found for a superset of the BSSIDs via :meth:`similar_bssids`.
+        """
+        if similar is None:
+            similar = self.similar_bssids(bs)
+
+        members = set(bs)
+        seen = set()
+        result = []
+        for key in bs:
+            if key in seen:
+                continue
+            # walk through all BSSIDs clustered with this one
+            result.append(key)
+            seen.add(key)
+            stack = [key]
+            while stack:
+                for other in similar.get(stack.pop(), ()):
+                    if other in members and other not in seen:
+                        seen.add(other)
+                        stack.append(other)
+        return result
+
+    def get_clusters(self, searcher, wifi_signals, queried_wifis,
+                     similar=None):
         """
         Filter out BSSIDs that are numerically very similar, assuming they're
         multiple interfaces on the same base station or such.
         """
         dissimilar_keys = set(self.filter_bssids_by_similarity(
-            [w.key for w in queried_wifis]))
+            [w.key for w in queried_wifis], similar=similar))
 
         if len(dissimilar_keys) < len(queried_wifis):
-            self.stat_time(
+            searcher.stat_time(
                 'wifi.provided_too_similar',
                 len(queried_wifis) - len(dissimilar_keys))
 
@@ -597,7 +858,7 @@ class WifiLocationProvider(AbstractLocationProvider):
 
         if len(wifi_networks) < MIN_WIFIS_IN_QUERY:
             # We didn't get enough matches.
-            self.stat_count('wifi.found_too_few')
+            searcher.query_stat_count('wifi.found_too_few')
 
         # Sort networks by signal strengths in query.
         wifi_networks.sort(
@@ -643,37 +904,43 @@ class WifiLocationProvider(AbstractLocationProvider):
                                      sample, WIFI_MIN_ACCURACY)
         return self.location_type(lat=avg_lat, lon=avg_lon, accuracy=accuracy)
 
-    def sufficient_data(self, wifi_keys):
-        return (len(self.filter_bssids_by_similarity(list(wifi_keys))) >=
-                MIN_WIFIS_IN_QUERY)
+    def sufficient_data(self, wifi_keys, similar=None):
+        return (len(self.filter_bssids_by_similarity(
+            list(wifi_keys), similar=similar)) >= MIN_WIFIS_IN_QUERY)
 
-    def locate(self, data):
+    def locate(self, query, searcher):
         location = self.location_type(query_data=False)
 
-        wifis, wifi_signals, wifi_keys = self.get_clean_wifi_keys(data)
+        wifi_signals = query.wifi
+        wifi_keys = set(wifi_signals)
 
         if len(wifi_keys) < MIN_WIFIS_IN_QUERY:
             # We didn't get enough keys.
             if len(wifi_keys) >= 1:
-                self.stat_count('wifi.provided_too_few')
+                searcher.query_stat_count('wifi.provided_too_few')
         else:
-            self.stat_time('wifi.provided', len(wifi_keys))
+            searcher.stat_time('wifi.provided', len(wifi_keys))
+
+            # find similar BSSIDs once and reuse them for the found wifis
+            similar = self.similar_bssids(wifi_keys)
 
-            if self.sufficient_data(wifi_keys):
+            if self.sufficient_data(wifi_keys, similar=similar):
                 location.query_data = True
 
-            queried_wifis = self.query_database(wifi_keys)
+            queried_wifis = searcher.prefetched_wifis
+            if queried_wifis is None:
+                queried_wifis = searcher.query_wifis(wifi_keys)
 
             if len(queried_wifis) < len(wifi_keys):
-                self.stat_count('wifi.partial_match')
-                self.stats_client.timing(
-                    '{api}.wifi.provided_not_known'.format(api=self.api_name),
-                    len(wifi_keys) - len(queried_wifis))
+                searcher.query_stat_count('wifi.partial_match')
+                searcher.stat_time('wifi.provided_not_known',
+                                   len(wifi_keys) - len(queried_wifis))
 
-            clusters = self.get_clusters(wifi_signals, queried_wifis)
+            clusters = self.get_clusters(
+                searcher, wifi_signals, queried_wifis, similar=similar)
 
             if len(clusters) == 0:
-                self.stat_count('wifi.found_no_cluster')
+                searcher.query_stat_count('wifi.found_no_cluster')
             else:
                 location = self.prepare_location(clusters)
 
@@ -685,13 +952,12 @@ class GeoIPLocationProvider(AbstractLocationProvider):
     A GeoIPLocationProvider implements a location search using a
     GeoIP client service lookup.
     """
-    db_source_field = 'geoip'
     data_field = 'geoip'
     log_name = 'geoip'
     log_group = 'geoip'
     source = DataSource.GeoIP
 
-    def locate(self, data):
+    def locate(self, query, searcher):
         """Provide a location given the provided client IP address.
 
         :rtype: :class:`~ichnaea.service.locate.AbstractLocation`
@@ -699,15 +965,16 @@ class GeoIPLocationProvider(AbstractLocationProvider):
         # Always consider there to be GeoIP data, even if no client_addr
         # was provided
         location = self.location_type(query_data=True)
-        client_addr = data.get(self.data_field, None)
+        client_addr = query.geoip
 
-        if client_addr and self.db_source is not None:
-            geoip = self.db_source.geoip_lookup(client_addr)
+        geoip_db = searcher.geoip_db
+        if client_addr and geoip_db is not None:
+            geoip = geoip_db.geoip_lookup(client_addr)
             if geoip:
                 if geoip['city']:
-                    self.stat_count('geoip_city_found')
+                    searcher.query_stat_count('geoip_city_found')
                 else:
-                    self.stat_count('geoip_country_found')
+                    searcher.query_stat_count('geoip_country_found')
 
                 location = self.location_type(
                     lat=geoip['latitude'],
@@ -739,25 +1006,265 @@ class AbstractLocationSearcher(StatsLogger):
     # long as it doesn't contradict the existing best-estimate.
 
     provider_classes = ()
+    _providers = None
 
     def __init__(self, db_sources, *args, **kwargs):
         super(AbstractLocationSearcher, self).__init__(*args, **kwargs)
+        self.session = db_sources.get('session')
+        self.geoip_db = db_sources.get('geoip')
+        self.station_cache = db_sources.get('station_cache')
+        self.concurrent_lookups = db_sources.get('concurrent_lookups')
+        self.response_cache = db_sources.get('response_cache')
+        self.cell_area_index = db_sources.get('cell_area_index')
+        self.prefetched_cells = None
+        self.prefetched_wifis = None
+        self.query_stats = None
+
+    @property
+    def all_providers(self):
+        # providers are stateless, so they are created once per class
+        # and shared between all requests
+        cls = type(self)
+        if cls.__dict__.get('_providers') is None:
+            cls._providers = [klass() for klass in cls.provider_classes]
+        return cls._providers
+
+    def lookup_stations(self, model_keys, session=None):
+        """
+        Look up the positions of stations for one or more models.
+
+        :param model_keys: A dict mapping station models to a list of
+            keys, which are converted into the model's hashkeys.
+        :param session: A database session to use instead of the
+            request's session.
+
+        :returns: A dict mapping each model to a dict of hashkeys to
+            `(lat, lon, range)` tuples, or `None` for unknown stations.
+
+        If a station cache is configured, it is consulted first and
+        only the remaining keys are looked up in the database.
+        """
+        cache = self.station_cache
+        log_stats = cache is not None and cache.log_stats
+        found = {}
+        missing = {}
+        for model, keys in model_keys.items():
+            keys = set([model.to_hashkey(key) for key in keys])
+            found[model] = {}
+            if cache is not None:
+                namespace = model.__tablename__
+                found[model], keys = cache.get_many(namespace, keys)
+                if found[model] and log_stats:
+                    self.stat_count(
+                        namespace + '.cache_hit', len(found[model]))
+                if keys and log_stats:
+                    self.stat_count(namespace + '.cache_miss', len(keys))
+            if keys:
+                missing[model] = keys
+
+        if missing:
+            if session is None:
+                session = self.session
+            queried = query_stations(session, missing)
+            for model, values in queried.items():
+                if cache is not None:
+                    # remember unknown stations as well
+                    cache.set_many(model.__tablename__, values)
+                found[model].update(values)
+
+        return found
+
+    def query_stations(self, model_keys, session=None):
+        """
+        Look up the positions of stations for one or more models.
+
+        :returns: A dict mapping each model to a list of
+            :class:`Network` tuples with the model's hashkey as the
+            network key. Stations without a position are skipped.
+        """
+        result = {}
+        stations = self.lookup_stations(model_keys, session=session)
+        for model, values in stations.items():
+            result[model] = [Network(key, *value)
+                             for key, value in values.items()
+                             if value is not None]
+        return result
+
+    def query_wifis(self, wifi_keys, session=None):
+        """
+        Look up the wifi stations for the given keys, returning
+        :class:`Network` tuples with the plain wifi key as the key.
+        """
+        queried_wifis = []
+        if len(wifi_keys) >= MIN_WIFIS_IN_QUERY:
+            keys = [Wifi.to_hashkey(key=key) for key in wifi_keys]
+            try:
+                queried_wifis = [
+                    wifi._replace(key=wifi.key.key) for wifi in
+                    self.query_stations({Wifi: keys}, session=session)[Wifi]]
+            except Exception:
+                self.raven_client.captureException()
+
+        return queried_wifis
+
+    def query_areas(self, models, cell_keys, session=None):
+        """
+        Look up cell areas in the cell area index, if one is configured.
+
+        :returns: A dict mapping each indexed model to a list of
+            :class:`Network` tuples. Models whose areas aren't loaded
+            into the index are left out, so they can be looked up in
+            the database instead.
+        """
+        index = self.cell_area_index
+        if index is None:
+            return {}
+        models = [model for model in models if model in index.models]
+        if not models:
+            return {}
+
+        try:
+            index.prepare(session if session is not None else self.session)
+        except Exception:
+            self.raven_client.captureException()
+            return {}
+
+        result = {}
+        for model in models:
+            found = index.get_many(model, cell_keys)
+            if found is not None:
+                result[model] = [
+                    Network(key, *value) for key, value in found.items()]
+        return result
+
+    def prefetch_cells(self, query, session=None):
+        """
+        Look up the stations for all cell providers in a single
+        database query. The cell providers then share this result,
+        instead of each issuing their own query. Cell areas are
+        taken from the cell area index, if one is configured.
+        """
+        models = set()
+        for provider in self.all_providers:
+            if isinstance(provider, AbstractCellLocationProvider):
+                models.update(provider.models)
 
-        self.all_providers = [
-            cls(
-                db_sources[cls.db_source_field],
-                api_key_log=self.api_key_log,
-                api_key_name=self.api_key_name,
-                api_name=self.api_name,
-            ) for cls in self.provider_classes]
+        stations = {}
+        if query.cell and models:
+            stations = self.query_areas(models, query.cell, session=session)
+            models = models - set(stations.keys())
+
+        if query.cell and models:
+            # only do a query if we have cell keys, or this will
+            # match all rows in the tables
+            try:
+                stations.update(self.query_stations(
+                    dict([(model, query.cell) for model in models]),
+                    session=session))
+            except Exception:
+                self.raven_client.captureException()
+
+        self.prefetched_cells = stations
+
+    def prefetch_wifis(self, query, session=None):
+        """
+        Look up the stations for the wifi provider ahead of time.
+        """
+        self.prefetched_wifis = None
+        if any([isinstance(provider, WifiLocationProvider)
+                for provider in self.all_providers]):
+            self.prefetched_wifis = self.query_wifis(
+                query.wifi, session=session)
+
+    def prefetch(self, query):
+        """
+        Look up the stations for all providers, either one after the
+        other or concurrently if configured.
+        """
+        lookups = [partial(self.prefetch_cells, query),
+                   partial(self.prefetch_wifis, query)]
+        if (self.concurrent_lookups is not None and query.cell and
+                len(query.wifi) >= MIN_WIFIS_IN_QUERY):
+            self.concurrent_lookups.run(lookups)
+        else:
+            for lookup in lookups:
+                lookup()
+
+    def prefetch_batch(self, queries):
+        """
+        Look up the stations of all queries in a batch at once.
+
+        The cell and wifi keys of all queries are deduplicated and
+        looked up in a single database query. The result replaces
+        the station cache of this searcher, so searching the individual
+        queries afterwards doesn't issue any further database queries.
+        """
+        models = set()
+        for provider in self.all_providers:
+            if isinstance(provider, AbstractCellLocationProvider):
+                models.update(provider.models)
+            elif isinstance(provider, WifiLocationProvider):
+                models.add(Wifi)
+        if self.cell_area_index is not None:
+            # loaded cell areas are looked up in the index for each query
+            models.difference_update(self.cell_area_index.loaded_models())
+
+        model_keys = defaultdict(set)
+        for query in queries:
+            for model in models:
+                if model is Wifi:
+                    if len(query.wifi) >= MIN_WIFIS_IN_QUERY:
+                        model_keys[Wifi].update(
+                            [Wifi.to_hashkey(key=key) for key in query.wifi])
+                else:
+                    model_keys[model].update(query.cell)
+        model_keys = dict([(model, keys)
+                           for model, keys in model_keys.items() if keys])
+        if not model_keys:
+            return
+
+        try:
+            stations = self.lookup_stations(model_keys)
+        except Exception:
+            self.raven_client.captureException()
+            return
+
+        self.station_cache = PrefetchedStations(
+            dict([(model.__tablename__, values)
+                  for model, values in stations.items()]))
+
+    def plan(self, query):
+        """
+        Return the providers which can contribute to the location of
+        the query, in order.
+
+        Providers without any data in the query are skipped, as they
+        would only return an empty location without query data, which
+        never changes the outcome of a search.
+        """
+        providers = []
+        skipped = set()
+        for provider in self.all_providers:
+            if provider.data_field != 'geoip' and \
+                    not getattr(query, provider.data_field):
+                skipped.add(provider.log_group)
+                continue
+            providers.append(provider)
+        for log_group in sorted(skipped):
+            self.query_stat_count('plan.skip_{group}'.format(group=log_group))
+        return providers
+
+    def search_location(self, query):
+        self.query_stats = stats = []
+        providers = self.plan(query)
+        self.prefetch(query)
 
-    def search_location(self, data):
         best_location = None
         best_location_provider = None
         all_locations = defaultdict(deque)
 
-        for provider in self.all_providers:
-            provider_location = provider.locate(data)
+        for provider in providers:
+            provider_location = provider.locate(query, self)
             all_locations[provider.log_group].appendleft(
                 (provider, provider_location))
 
@@ -777,7 +1284,7 @@ class AbstractLocationSearcher(StatsLogger):
         if not best_location.found():
             self.stat_count('miss')
         else:
-            best_location_provider.log_hit()
+            self._query_stat('log_hit', best_location_provider.log_name)
 
         # Log a hit/miss metric for the first data source for
         # which the user provided sufficient data
@@ -793,22 +1300,86 @@ class AbstractLocationSearcher(StatsLogger):
                         found_provider = provider
                         break
                 if found_provider:
-                    found_provider.log_success()
+                    self._query_stat('log_success', found_provider.log_name)
                 else:
-                    first_provider.log_failure()
+                    self._query_stat('log_failure', first_provider.log_name)
                 break
 
-        return best_location
+        self.query_stats = None
+        return (best_location, stats)
+
+    def _query_stat(self, method, name):
+        # The stats describing the outcome of a query are kept as
+        # (method, name) pairs, so they can be logged again for
+        # cached responses.
+        stat = (method, name)
+        if self.query_stats is not None:
+            self.query_stats.append(stat)
+        self.log_query_stats([stat])
+
+    def query_stat_count(self, stat):
+        """
+        Count a stat describing the outcome of the current query,
+        which is counted again if the response is served from the
+        response cache.
+        """
+        self._query_stat('stat_count', stat)
+
+    def log_query_stats(self, stats):
+        """
+        Log the query stats returned by :meth:`search_location`. These
+        are either counters or a provider logging method and the
+        provider's log name.
+        """
+        providers = {}
+        for provider in reversed(self.all_providers):
+            providers[provider.log_name] = provider
+        for method, name in stats:
+            if method == 'stat_count':
+                self.stat_count(name)
+            else:
+                getattr(providers[name], method)(self)
 
     def prepare_location(self, country, location):  # pragma: no cover
         raise NotImplementedError()
 
+    def search_query(self, query):
+        namespace = type(self).__name__.lower()
+        fingerprint = None
+        if self.response_cache is not None:
+            fingerprint = query_fingerprint(query)
+        if fingerprint is not None:
+            cached = self.response_cache.get(namespace, fingerprint)
+            if cached is not None:
+                self.stat_count('response_cache.hit')
+                self.log_query_stats(cached['stats'])
+                return cached['result']
+            self.stat_count('response_cache.miss')
+
+        location, stats = self.search_location(query)
+        if not location.found():
+            return None
+
+        result = self.prepare_location(location)
+        if fingerprint is not None and location.source != DataSource.GeoIP:
+            # GeoIP results depend on the client address, which isn't
+            # part of the fingerprint
+            self.response_cache.set(namespace, fingerprint,
+                                    {'result': result, 'stats': stats})
+        return result
+
     def search(self, data):
         """Provide a type specific search location or return None."""
-        location = self.search_location(data)
-        if location.found():
-            return self.prepare_location(location)
-        return None
+        return self.search_query(clean_query(data))
+
+    def search_batch(self, queries):
+        """
+        Provide a type specific search location or None for each
+        of the queries, looking up all their stations at once.
+        """
+        queries = [clean_query(data) for data in queries]
+        self.prefetch_batch(queries)
+        return [self.search_query(query) for query in queries]
 
 
 class PositionSearcher(AbstractLocationSearcher):
@@ -834,6 +1405,25 @@ class PositionSearcher(AbstractLocationSearcher):
         }
 
 
+def position_searcher(request, api_name):
+    """
+    Create a :class:`PositionSearcher` for a request to the given API,
+    using the data sources configured in the application registry.
+    """
+    registry = request.registry
+    return PositionSearcher(
+        {'geoip': registry.geoip_db,
+         'session': request.db_ro_session,
+         'station_cache': registry.station_cache,
+         'concurrent_lookups': registry.concurrent_lookups,
+         'response_cache': registry.response_cache,
+         'cell_area_index': registry.cell_area_index},
+        api_key_log=getattr(request, 'api_key_log', False),
+        api_key_name=getattr(request, 'api_key_name', None),
+        api_name=api_name,
+    )
+
+
 class CountrySearcher(AbstractLocationSearcher):
     """
     A CountrySearcher will return a country name and code.
@@ -3,6 +3,11 @@ import time
 from pyramid.httpexceptions import HTTPServiceUnavailable
 from pyramid.view import view_config
 
+from ichnaea.db import (
+    ReplicaSet,
+    STATEMENT_CACHE,
+)
+
 
 def configure_monitor(config):
     config.scan('ichnaea.service.monitor.views')
@@ -33,7 +38,18 @@ def _check_timed(ping_function):
 
 
 def check_database(request):
-    return _check_timed(request.db_ro_session.ping)
+    db_ro = request.registry.db_ro
+    if isinstance(db_ro, ReplicaSet):
+        # up if at least one replica is up
+        result = _check_timed(db_ro.ping)
+        result['replicas'] = db_ro.state()
+    else:
+        result = _check_timed(request.db_ro_session.ping)
+        if result['up']:
+            result.update(db_ro.connection_stats())
+    if result['up']:
+        result['statement_cache'] = STATEMENT_CACHE.stats()
+    return result
 
 
 def check_geoip(request):
@@ -1,6 +1,6 @@
 from ichnaea.service.base import check_api_key
 from ichnaea.service.error import preprocess_request
-from ichnaea.service.locate import PositionSearcher
+from ichnaea.service.locate import position_searcher
 from ichnaea.service.search.schema import SearchSchema
 
 
@@ -18,13 +18,7 @@ def search_view(request):
     )
 
     data['geoip'] = request.client_addr
-    session = request.db_ro_session
-    result = PositionSearcher(
-        {'geoip': request.registry.geoip_db, 'session': session},
-        api_key_log=getattr(request, 'api_key_log', False),
-        api_key_name=getattr(request, 'api_key_name', None),
-        api_name='search',
-    ).search(data)
+    result = position_searcher(request, 'search').search(data)
 
     if not result:
         return {'status': 'not_found'}
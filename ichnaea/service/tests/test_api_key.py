@@ -0,0 +1,93 @@
+import time
+
+from ichnaea.models import ApiKey
+from ichnaea.service.base import (
+    ApiKeyCache,
+    configure_api_key_cache,
+    invalidate_api_keys,
+)
+from ichnaea.tests.base import (
+    DBTestCase,
+    RedisIsolation,
+)
+
+
+class TestApiKeyCache(DBTestCase, RedisIsolation):
+
+    default_session = 'db_ro_session'
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestApiKeyCache, cls).setUpClass()
+        super(TestApiKeyCache, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestApiKeyCache, cls).teardown_redis()
+        super(TestApiKeyCache, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestApiKeyCache, self).setUp()
+        self.now = 1000.0
+        self.session.add(ApiKey(valid_key='a', maxreq=10, shortname='a'))
+        self.session.flush()
+
+    def tearDown(self):
+        self.cleanup_redis()
+        super(TestApiKeyCache, self).tearDown()
+
+    def _make_cache(self, **kw):
+        return ApiKeyCache(refresh=60, invalid_ttl=30,
+                           _timer=lambda: self.now, **kw)
+
+    def test_snapshot(self):
+        cache = self._make_cache()
+        with self.db_call_checker() as check_db_calls:
+            self.assertEqual(cache.get(self.session, 'a'), (10, None, 'a'))
+            check_db_calls(ro=1)
+        with self.db_call_checker() as check_db_calls:
+            self.assertEqual(cache.get(self.session, 'a'), (10, None, 'a'))
+            check_db_calls(ro=0)
+
+    def test_refresh(self):
+        cache = self._make_cache()
+        cache.get(self.session, 'a')
+        self.session.query(ApiKey).filter(
+            ApiKey.valid_key == 'a').update({'maxreq': 20})
+        self.now += 30
+        self.assertEqual(cache.get(self.session, 'a')[0], 10)
+        self.now += 31
+        self.assertEqual(cache.get(self.session, 'a')[0], 20)
+
+    def test_fallback_and_invalid(self):
+        cache = self._make_cache()
+        cache.get(self.session, 'a')
+        self.session.add(ApiKey(valid_key='b', maxreq=5, shortname='b'))
+        self.session.flush()
+        with self.db_call_checker() as check_db_calls:
+            self.assertEqual(cache.get(self.session, 'b'), (5, None, 'b'))
+            self.assertEqual(cache.get(self.session, 'c'), None)
+            self.assertEqual(cache.get(self.session, 'b'), (5, None, 'b'))
+            self.assertEqual(cache.get(self.session, 'c'), None)
+            check_db_calls(ro=2)
+
+        self.session.add(ApiKey(valid_key='c', maxreq=1, shortname='c'))
+        self.session.flush()
+        self.now += 31
+        self.assertEqual(cache.get(self.session, 'c'), (1, None, 'c'))
+
+    def test_invalidate(self):
+        cache = self._make_cache(redis_client=self.redis_client)
+        cache.get(self.session, 'a')
+        self.session.query(ApiKey).filter(
+            ApiKey.valid_key == 'a').update({'maxreq': 20})
+        invalidate_api_keys(self.redis_client)
+        time.sleep(0.05)
+        self.assertEqual(cache.get(self.session, 'a')[0], 20)
+
+    def test_configure(self):
+        self.assertTrue(configure_api_key_cache({}) is None)
+        cache = configure_api_key_cache({'api_key_cache_refresh': '120'})
+        self.assertEqual(cache.refresh, 120)
+        self.assertEqual(cache.invalid.ttl, 120)
+        self.assertTrue(cache.pubsub is None)
@@ -0,0 +1,160 @@
+import time
+
+from ichnaea.data.area import publish_area_update
+from ichnaea.models import (
+    Cell,
+    CellArea,
+    OCIDCellArea,
+    Radio,
+)
+from ichnaea.service.area import (
+    CellAreaIndex,
+    configure_cell_area_index,
+)
+from ichnaea.tests.base import (
+    DBTestCase,
+    RedisIsolation,
+)
+
+
+class TestCellAreaIndex(DBTestCase, RedisIsolation):
+
+    default_session = 'db_ro_session'
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCellAreaIndex, cls).setUpClass()
+        super(TestCellAreaIndex, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestCellAreaIndex, cls).teardown_redis()
+        super(TestCellAreaIndex, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestCellAreaIndex, self).setUp()
+        self.now = 1000.0
+        self.area_key = dict(radio=Radio.gsm, mcc=1, mnc=2, lac=3)
+        self.session.add_all([
+            CellArea(lat=1.0, lon=2.0, range=1000, **self.area_key),
+            CellArea(lat=None, lon=None, range=0,
+                     radio=Radio.gsm, mcc=1, mnc=2, lac=4),
+            OCIDCellArea(lat=1.5, lon=2.5, range=2000, **self.area_key),
+        ])
+        self.session.flush()
+        self.cell_keys = [
+            Cell.to_hashkey(cid=1, **self.area_key),
+            Cell.to_hashkey(cid=2, **self.area_key),
+            Cell.to_hashkey(radio=Radio.gsm, mcc=1, mnc=2, lac=4, cid=1),
+        ]
+
+    def tearDown(self):
+        self.cleanup_redis()
+        super(TestCellAreaIndex, self).tearDown()
+
+    def _make_index(self, **kw):
+        return CellAreaIndex(refresh=60, _timer=lambda: self.now, **kw)
+
+    def test_get_many(self):
+        index = self._make_index()
+        with self.db_call_checker() as check_db_calls:
+            index.prepare(self.session)
+            check_db_calls(ro=2)
+        with self.db_call_checker() as check_db_calls:
+            index.prepare(self.session)
+            check_db_calls(ro=0)
+
+        area_key = CellArea.to_hashkey(**self.area_key)
+        self.assertEqual(index.get_many(CellArea, self.cell_keys),
+                         {area_key: (1.0, 2.0, 1000)})
+        self.assertEqual(index.get_many(OCIDCellArea, self.cell_keys),
+                         {area_key: (1.5, 2.5, 2000)})
+
+    def test_refresh(self):
+        index = self._make_index()
+        index.prepare(self.session)
+        self.session.query(CellArea).update({'range': 500})
+        self.now += 30
+        index.prepare(self.session)
+        self.assertEqual(
+            index.get_many(CellArea, self.cell_keys).values()[0][2], 1000)
+        self.now += 31
+        index.prepare(self.session)
+        self.assertEqual(
+            index.get_many(CellArea, self.cell_keys).values()[0][2], 500)
+
+    def test_update(self):
+        index = self._make_index(redis_client=self.redis_client)
+        index.prepare(self.session)
+        area_key = CellArea.to_hashkey(**self.area_key)
+        self.session.query(CellArea).update({'range': 500})
+        self.session.query(OCIDCellArea).delete()
+        publish_area_update(self.redis_client, CellArea, area_key)
+        publish_area_update(self.redis_client, OCIDCellArea, area_key)
+        time.sleep(0.05)
+
+        with self.db_call_checker() as check_db_calls:
+            index.prepare(self.session)
+            check_db_calls(ro=2)
+        self.assertEqual(index.get_many(CellArea, self.cell_keys),
+                         {area_key: (1.0, 2.0, 500)})
+        self.assertEqual(index.get_many(OCIDCellArea, self.cell_keys), {})
+
+    def test_unloaded(self):
+        index = self._make_index()
+        self.assertTrue(index.get_many(CellArea, self.cell_keys) is None)
+        self.assertEqual(index.loaded_models(), set())
+
+    def test_background_reload(self):
+        spawned = []
+        index = self._make_index(
+            session_factory=lambda: SharedSession(self.session),
+            _spawn=spawned.append)
+        with self.db_call_checker() as check_db_calls:
+            index.prepare(self.session)
+            check_db_calls(ro=0)
+        self.assertTrue(index.get_many(CellArea, self.cell_keys) is None)
+
+        # only one reload runs at a time
+        self.now += 61
+        index.prepare(self.session)
+        self.assertEqual(len(spawned), 1)
+        spawned[0]()
+        self.assertFalse(index.reloading)
+        self.assertEqual(index.loaded_models(), set(index.models))
+        self.assertEqual(
+            index.get_many(CellArea, self.cell_keys).values(),
+            [(1.0, 2.0, 1000)])
+
+        # the old index is used until the new one is loaded
+        self.session.query(CellArea).update({'range': 500})
+        self.now += 61
+        index.prepare(self.session)
+        self.assertEqual(len(spawned), 2)
+        self.assertEqual(
+            index.get_many(CellArea, self.cell_keys).values()[0][2], 1000)
+        spawned[1]()
+        self.assertEqual(
+            index.get_many(CellArea, self.cell_keys).values()[0][2], 500)
+
+    def test_configure(self):
+        self.assertTrue(configure_cell_area_index({}) is None)
+        index = configure_cell_area_index({'cell_area_index_refresh': '600'})
+        self.assertEqual(index.refresh, 600)
+        self.assertTrue(index.pubsub is None)
+
+
+class SharedSession(object):
+    # lets the background reload see the test's uncommitted data
+
+    def __init__(self, session):
+        self.session = session
+
+    def execute(self, *args, **kw):
+        return self.session.execute(*args, **kw)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,74 @@
+import zlib
+
+from pyramid.testing import DummyRequest
+
+from ichnaea.service.error import (
+    BodyTooLarge,
+    gunzip,
+    MSG_TOO_LARGE,
+    preprocess_request,
+    verify_schema,
+)
+from ichnaea.service.geolocate.schema import GeoLocateSchema
+from ichnaea.service.search.schema import SearchSchema
+from ichnaea.tests.base import TestCase
+
+
+def gzip_data(data):
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestGunzip(TestCase):
+
+    def test_gunzip(self):
+        data = 'abcdef' * 100000
+        self.assertEqual(gunzip(gzip_data(data), chunk_size=1000), data)
+
+    def test_empty(self):
+        self.assertEqual(gunzip(gzip_data('')), '')
+
+    def test_too_large(self):
+        data = gzip_data('\x00' * 100000)
+        self.assertEqual(len(gunzip(data, max_size=100000)), 100000)
+        self.assertRaises(BodyTooLarge, gunzip, data,
+                          max_size=99999, chunk_size=1000)
+
+    def test_preprocess_request(self):
+        request = DummyRequest(headers={'Content-Encoding': 'gzip'})
+        request.body = gzip_data('{"cell": [], "wifi": [], "x": "%s"}' % (
+            'a' * (11 * 1024 * 1024)))
+        data, errors = preprocess_request(
+            request, SearchSchema(), response=None)
+        self.assertEqual(errors, [dict(name=None, description=MSG_TOO_LARGE)])
+
+
+class TestVerifySchema(TestCase):
+
+    def _verify(self, body):
+        errors = []
+        validated = {}
+        verify_schema(GeoLocateSchema(), body, errors, validated)
+        return (validated, errors)
+
+    def test_valid(self):
+        validated, errors = self._verify({
+            'radioType': 'gsm',
+            'cellTowers': [{'mobileCountryCode': 1, 'mobileNetworkCode': 2}],
+        })
+        self.assertEqual(errors, [])
+        self.assertEqual(validated['radioType'], 'gsm')
+        self.assertEqual(validated['wifiAccessPoints'], ())
+        self.assertEqual(validated['cellTowers'][0]['cellId'], None)
+
+    def test_invalid(self):
+        validated, errors = self._verify({
+            'carrier': 'a',
+            'radioType': 'gsm',
+            'cellTowers': [{'mobileCountryCode': 1}],
+        })
+        self.assertEqual(errors, [{
+            'name': 'cellTowers.0.mobileNetworkCode',
+            'description': 'Required'}])
+        self.assertEqual(validated['radioType'], 'gsm')
+        self.assertFalse('cellTowers' in validated)
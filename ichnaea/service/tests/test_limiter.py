@@ -1,6 +1,11 @@
 import time
 
-from ichnaea.service.base import rate_limit
+from ichnaea.service.base import (
+    configure_rate_limiter,
+    LocalRateLimiter,
+    rate_limit,
+    rate_limit_key,
+)
 from ichnaea.tests.base import (
     RedisIsolation,
     TestCase,
@@ -45,3 +50,110 @@ class TestLimiter(TestCase, RedisIsolation):
         self.assertFalse(rate_limit(redis_client, a,
                                     maxreq=maxreq,
                                     expire=expire))
+
+    def test_limiter_count(self):
+        redis_client = self.redis_client
+        a = 'key_c'
+        maxreq = 5
+        expire = 1
+        self.assertFalse(rate_limit(redis_client, a,
+                                    maxreq=maxreq,
+                                    expire=expire,
+                                    count=4))
+        self.assertTrue(rate_limit(redis_client, a,
+                                   maxreq=maxreq,
+                                   expire=expire,
+                                   count=2))
+        self.assertFalse(rate_limit(redis_client, a,
+                                    maxreq=maxreq,
+                                    expire=expire))
+
+
+class TestLocalRateLimiter(TestCase, RedisIsolation):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestLocalRateLimiter, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestLocalRateLimiter, cls).teardown_redis()
+
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = LocalRateLimiter(
+            self.redis_client, interval=0.5, min_maxreq=10,
+            _timer=lambda: self.now)
+
+    def tearDown(self):
+        self.cleanup_redis()
+
+    def _redis_count(self, api_key):
+        return int(self.redis_client.get(rate_limit_key(api_key)) or 0)
+
+    def test_local_counts(self):
+        for i in range(10):
+            self.assertFalse(self.limiter.limit('a', maxreq=10))
+        self.assertTrue(self.limiter.limit('a', maxreq=10))
+        # nothing was flushed yet
+        self.assertEqual(self._redis_count('a'), 0)
+
+        self.now += 1
+        self.limiter.sync()
+        self.assertEqual(self._redis_count('a'), 10)
+        self.assertTrue(self.limiter.limit('a', maxreq=10))
+
+    def test_global_counts(self):
+        self.redis_client.incr(rate_limit_key('b'), 15)
+        self.assertFalse(self.limiter.limit('b', maxreq=20, count=5))
+        self.assertTrue(self.limiter.limit('b', maxreq=20))
+
+        # the global counter was lowered outside of this worker
+        self.redis_client.decr(rate_limit_key('b'), 10)
+        self.now += 1
+        self.assertFalse(self.limiter.limit('b', maxreq=20))
+        self.assertEqual(self._redis_count('b'), 10)
+
+    def test_small_limit_uses_redis(self):
+        for i in range(5):
+            self.assertFalse(self.limiter.limit('c', maxreq=5))
+        self.assertEqual(self._redis_count('c'), 5)
+        self.assertTrue(self.limiter.limit('c', maxreq=5))
+
+    def test_no_limit(self):
+        self.assertFalse(self.limiter.limit('d', maxreq=0))
+        self.assertFalse(self.limiter.limit('d', maxreq=None))
+
+    def test_background_sync(self):
+        limiter = LocalRateLimiter(
+            self.redis_client, interval=0.05, min_maxreq=10)
+        limiter.start()
+        try:
+            for i in range(3):
+                self.assertFalse(limiter.limit('e', maxreq=10))
+            # the counts are flushed without any further limit call
+            for i in range(20):
+                if self._redis_count('e') == 3:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(self._redis_count('e'), 3)
+        finally:
+            limiter.stop()
+
+    def test_stop_flushes(self):
+        self.assertFalse(self.limiter.limit('f', maxreq=10, count=2))
+        self.assertEqual(self._redis_count('f'), 0)
+        self.limiter.stop()
+        self.assertEqual(self._redis_count('f'), 2)
+
+    def test_configure(self):
+        self.assertTrue(configure_rate_limiter({}, self.redis_client) is None)
+        self.assertTrue(configure_rate_limiter(
+            {'rate_limit_sync_interval': '0.5'}, None) is None)
+        limiter = configure_rate_limiter(
+            {'rate_limit_sync_interval': '0.2',
+             'rate_limit_local_min_maxreq': '500'}, self.redis_client)
+        self.assertEqual(limiter.interval, 0.2)
+        self.assertEqual(limiter.min_maxreq, 500)
+        self.assertTrue(limiter._thread is not None)
+        limiter.stop()
@@ -1,5 +1,10 @@
+from functools import partial
 import random
 
+from ichnaea.cache import (
+    ResponseCache,
+    StationCache,
+)
 from ichnaea.constants import (
     CELL_MIN_ACCURACY,
     LAC_MIN_ACCURACY,
@@ -25,16 +30,303 @@ from ichnaea.tests.base import (
     GB_LON,
     GB_MCC,
     GeoIPIsolation,
+    LogIsolation,
     PARIS_LAT,
     PARIS_LON,
     PORTO_ALEGRE_LAT,
     PORTO_ALEGRE_LON,
     SAO_PAULO_LAT,
     SAO_PAULO_LON,
+    TestCase,
     USA_MCC,
     VIVO_MNC,
 )
 from ichnaea.service import locate
+from ichnaea.service.area import CellAreaIndex
+
+
+class TestCleanQuery(TestCase):
+
+    def test_empty(self):
+        query = locate.clean_query({})
+        self.assertEqual(query, locate.Query(geoip=None, cell=[], wifi={}))
+
+    def test_cells(self):
+        cell = {'radio': None, 'mcc': GB_MCC, 'mnc': 1, 'lac': 2, 'cid': 3}
+        query = locate.clean_query({
+            'radio': 'umts',
+            'cell': [dict(cell), dict(cell, mcc=0), dict(cell, radio='gsm')],
+        })
+        self.assertEqual([key.radio for key in query.cell],
+                         [Radio.umts, Radio.gsm])
+        self.assertEqual(query.cell[0].cid, 3)
+
+    def test_wifis(self):
+        query = locate.clean_query({
+            'geoip': '127.0.0.1',
+            'wifi': [
+                {'key': '00:11:22:33:44:55', 'signal': -80},
+                {'key': '001122334466'},
+                {'key': 'invalid'},
+            ],
+        })
+        self.assertEqual(query.geoip, '127.0.0.1')
+        self.assertEqual(query.wifi, {'001122334455': -80,
+                                      '001122334466': -100})
+
+
+class TestQueryFingerprint(TestCase):
+
+    cell = {'radio': 'gsm', 'mcc': GB_MCC, 'mnc': 1, 'lac': 2, 'cid': 3}
+    wifis = [{'key': '001122334455', 'signal': -80},
+             {'key': '112233445566'}]
+
+    def _fingerprint(self, data):
+        return locate.query_fingerprint(locate.clean_query(data))
+
+    def test_empty(self):
+        self.assertTrue(self._fingerprint({}) is None)
+        self.assertTrue(self._fingerprint({'geoip': '127.0.0.1'}) is None)
+
+    def test_normalized(self):
+        fingerprint = self._fingerprint({
+            'geoip': '127.0.0.1',
+            'cell': [self.cell, dict(self.cell, cid=4)],
+            'wifi': self.wifis,
+        })
+        self.assertEqual(len(fingerprint), 40)
+        self.assertEqual(fingerprint, self._fingerprint({
+            'geoip': '127.0.0.2',
+            'radio': 'gsm',
+            'cell': [dict(self.cell, cid=4, radio=None), self.cell],
+            'wifi': [{'key': '11:22:33:44:55:66', 'signal': -60},
+                     {'key': '001122334455'}],
+        }))
+
+    def test_different(self):
+        fingerprints = set([
+            self._fingerprint({'cell': [self.cell]}),
+            self._fingerprint({'cell': [dict(self.cell, cid=4)]}),
+            self._fingerprint({'cell': [dict(self.cell, radio='umts')]}),
+            self._fingerprint({'wifi': self.wifis}),
+            self._fingerprint({'wifi': self.wifis[:1]}),
+            self._fingerprint({'cell': [self.cell], 'wifi': self.wifis}),
+        ])
+        self.assertEqual(len(fingerprints), 6)
+
+
+class TestSearcherPlan(TestCase, LogIsolation):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSearcherPlan, cls).setUpClass()
+        cls.setup_logging()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestSearcherPlan, cls).tearDownClass()
+        cls.teardown_logging()
+
+    def setUp(self):
+        super(TestSearcherPlan, self).setUp()
+        self.clear_log_messages()
+
+    def _searcher(self):
+        return locate.PositionSearcher(
+            {}, api_key_log=False, api_key_name='test', api_name='m')
+
+    def test_shared_providers(self):
+        providers = self._searcher().all_providers
+        self.assertEqual([type(provider) for provider in providers],
+                         list(locate.PositionSearcher.provider_classes))
+        self.assertTrue(all([a is b for a, b in zip(
+            providers, self._searcher().all_providers)]))
+        self.assertNotEqual(
+            [type(provider) for provider in
+             locate.CountrySearcher({}, 'test', False, 'm').all_providers],
+            [type(provider) for provider in providers])
+
+    def test_geoip_only(self):
+        plan = self._searcher().plan(
+            locate.Query(geoip='127.0.0.1', cell=[], wifi={}))
+        self.assertEqual([type(provider) for provider in plan],
+                         [locate.PositionGeoIPLocationProvider])
+        self.check_stats(counter=['m.plan.skip_cell', 'm.plan.skip_wifi'])
+
+    def test_all_data(self):
+        query = locate.clean_query({
+            'cell': [{'radio': 'gsm', 'mcc': GB_MCC, 'mnc': 1,
+                      'lac': 2, 'cid': 3}],
+            'wifi': [{'key': '00:11:22:33:44:55'}],
+        })
+        plan = self._searcher().plan(query)
+        self.assertEqual([type(provider) for provider in plan],
+                         list(locate.PositionSearcher.provider_classes))
+        self.check_stats(total=0)
+
+
+class TestWifiClustering(TestCase):
+
+    def setUp(self):
+        self.provider = locate.WifiLocationProvider()
+
+    def _cluster(self, items, threshold=1):
+        return self.provider.cluster_elements(
+            items, lambda a, b: abs(a - b), threshold)
+
+    def test_empty(self):
+        self.assertEqual(self._cluster([]), [])
+
+    def test_single_linkage(self):
+        # 10 and 12 are only joined via 11
+        self.assertEqual(self._cluster([10, 12, 20, 11, 30, 21]),
+                         [[10, 12, 11], [20, 21], [30]])
+
+    def test_keep_item_order(self):
+        self.assertEqual(self._cluster([5, 1, 4, 2, 3]),
+                         [[5, 1, 4, 2, 3]])
+        self.assertEqual(self._cluster([5, 1, 4, 2, 3], threshold=0),
+                         [[5], [1], [4], [2], [3]])
+
+    def test_filter_bssids_by_similarity(self):
+        self.assertEqual(
+            self.provider.filter_bssids_by_similarity(
+                ['00000000000a', '00000000000b', '00000000000c',
+                 '0000000000f0', '0000000a0000']),
+            ['00000000000a', '0000000000f0', '0000000a0000'])
+
+    def test_filter_bssids_by_similarity_hamming(self):
+        self.assertEqual(
+            self.provider.filter_bssids_by_similarity(
+                ['800000000000', '000000000000', '030000000001']),
+            ['800000000000', '030000000001'])
+
+    def test_similar_bssids_reused_for_subset(self):
+        keys = ['00000000000f', '000000000011', '000000000013']
+        similar = self.provider.similar_bssids(keys)
+        self.assertEqual(similar['000000000011'],
+                         set(['00000000000f', '000000000013']))
+        self.assertEqual(
+            self.provider.filter_bssids_by_similarity(
+                keys, similar=similar),
+            ['00000000000f'])
+        # without the middle key, the outer keys aren't clustered
+        self.assertEqual(
+            self.provider.filter_bssids_by_similarity(
+                [keys[0], keys[2]], similar=similar),
+            [keys[0], keys[2]])
+
+
+class TestConcurrentLookups(TestCase):
+
+    def _lookups(self, per_request=2, limit=2, max_overflow=10):
+        self.sessions = []
+        self.pool = DummyPool()
+
+        def session_factory():
+            session = DummySession(self.pool)
+            self.sessions.append(session)
+            return session
+
+        return locate.ConcurrentLookups(
+            session_factory, per_request=per_request, limit=limit,
+            max_overflow=max_overflow)
+
+    def _functions(self, count):
+        calls = []
+
+        def function(i, session=None):
+            calls.append((i, session))
+        return calls, [partial(function, i) for i in range(count)]
+
+    def test_configure(self):
+        self.assertTrue(
+            locate.configure_concurrent_lookups({}, None) is None)
+        lookups = locate.configure_concurrent_lookups(
+            {'locate_concurrency': '3'}, None, max_overflow=5)
+        self.assertEqual(lookups.per_request, 3)
+        self.assertEqual(lookups.max_overflow, 5)
+        self.assertEqual(lookups.semaphore.counter, 20)
+
+    def test_run(self):
+        lookups = self._lookups()
+        calls, functions = self._functions(3)
+        lookups.run(functions)
+        self.assertEqual(len(calls), 3)
+        sessions = dict(calls)
+        # one lookup ran in its own greenlet with its own session
+        self.assertEqual(sessions[0], None)
+        self.assertEqual(sessions[1], self.sessions[0])
+        self.assertEqual(sessions[2], None)
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEqual(lookups.semaphore.counter, 2)
+
+    def test_limit(self):
+        lookups = self._lookups(limit=1)
+        lookups.semaphore.acquire()
+        calls, functions = self._functions(2)
+        lookups.run(functions)
+        self.assertEqual(dict(calls), {0: None, 1: None})
+        self.assertEqual(self.sessions, [])
+
+    def test_pool_exhausted(self):
+        lookups = self._lookups()
+        self.pool.idle = 0
+        self.pool.overflow_count = 10
+        calls, functions = self._functions(2)
+        lookups.run(functions)
+        # the lookup runs inline instead of waiting for a connection
+        self.assertEqual(dict(calls), {0: None, 1: None})
+        self.assertTrue(self.sessions[0].closed)
+        self.assertFalse(self.sessions[0].connected)
+        self.assertEqual(lookups.semaphore.counter, 2)
+
+    def test_pool_unlimited_overflow(self):
+        lookups = self._lookups(max_overflow=-1)
+        self.pool.idle = 0
+        self.pool.overflow_count = 10
+        calls, functions = self._functions(2)
+        lookups.run(functions)
+        # the pool can always open another connection
+        self.assertEqual(dict(calls), {0: None, 1: self.sessions[0]})
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEqual(lookups.semaphore.counter, 2)
+
+
+class DummyPool(object):
+
+    idle = 1
+    overflow_count = 0
+
+    def checkedin(self):
+        return self.idle
+
+    def overflow(self):
+        return self.overflow_count
+
+
+class DummySession(object):
+
+    closed = False
+    connected = False
+
+    def __init__(self, pool=None):
+        self.bind = DummyBind(pool)
+
+    def connection(self):
+        self.connected = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class DummyBind(object):
+
+    def __init__(self, pool):
+        self.pool = pool
 
 
 class BaseLocateTest(DBTestCase, GeoIPIsolation):
@@ -53,13 +345,19 @@ class BaseLocateTest(DBTestCase, GeoIPIsolation):
         DBTestCase.tearDownClass()
 
     def _make_query(self, data=None, client_addr=None,
-                    api_key_log=False, api_key_name='test'):
+                    api_key_log=False, api_key_name='test',
+                    station_cache=None, response_cache=None,
+                    cell_area_index=None):
         if data is None:
             data = {'geoip': None, 'cell': [], 'wifi': []}
         if client_addr:
             data['geoip'] = client_addr
         return self.searcher(
-            {'geoip': self.geoip_db, 'session': self.session},
+            {'geoip': self.geoip_db,
+             'session': self.session,
+             'station_cache': station_cache,
+             'response_cache': response_cache,
+             'cell_area_index': cell_area_index},
             api_key_log=api_key_log,
             api_key_name=api_key_name,
             api_name='m',
@@ -241,6 +539,63 @@ class TestPositionSearcher(BaseLocateTest):
             ],
         )
 
+    def test_cell_single_query(self):
+        cell_key = {'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
+        self.session.add(Cell(lat=GB_LAT, lon=GB_LON, range=6000,
+                              radio=Radio.gsm, cid=1, **cell_key))
+        self.session.add(CellArea(lat=GB_LAT, lon=GB_LON, range=9000,
+                                  radio=Radio.gsm, **cell_key))
+        self.session.add(OCIDCell(lat=GB_LAT, lon=GB_LON, range=7000,
+                                  radio=Radio.gsm, cid=2, **cell_key))
+        self.session.flush()
+
+        with self.db_call_checker() as check_db_calls:
+            result = self._make_query(data={'cell': [
+                dict(cid=1, radio=Radio.gsm.name, **cell_key),
+                dict(cid=2, radio=Radio.gsm.name, **cell_key),
+            ]})
+            check_db_calls(ro=1)
+
+        self.assertEqual(result,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON,
+                          'accuracy': 6000})
+
+    def test_batch_single_query(self):
+        cell_key = {'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
+        self.session.add(Cell(lat=GB_LAT, lon=GB_LON, range=6000,
+                              radio=Radio.gsm, cid=1, **cell_key))
+        wifis = [{'key': '001122334455'}, {'key': '112233445566'}]
+        self.session.add(Wifi(
+            key=wifis[0]['key'], lat=GB_LAT, lon=GB_LON, range=200))
+        self.session.add(Wifi(
+            key=wifis[1]['key'], lat=GB_LAT, lon=GB_LON + 0.00001, range=300))
+        self.session.flush()
+
+        cell_query = {'cell': [dict(cid=1, radio=Radio.gsm.name, **cell_key)]}
+        queries = [
+            cell_query,
+            {'wifi': wifis},
+            {'cell': [dict(cid=2, radio=Radio.gsm.name, **cell_key)]},
+            cell_query,
+        ]
+        searcher = self.searcher(
+            {'geoip': self.geoip_db, 'session': self.session},
+            api_key_log=False, api_key_name='test', api_name='m')
+
+        with self.db_call_checker() as check_db_calls:
+            results = searcher.search_batch(queries)
+            check_db_calls(ro=1)
+
+        cell_result = {'lat': GB_LAT, 'lon': GB_LON, 'accuracy': 6000}
+        self.assertEqual(results[0], cell_result)
+        self.assertEqual(results[1],
+                         {'lat': GB_LAT,
+                          'lon': GB_LON + 0.000005,
+                          'accuracy': WIFI_MIN_ACCURACY})
+        self.assertTrue(results[2] is None)
+        self.assertEqual(results[3], cell_result)
+
     def test_ocid_cell(self):
         london = self.geoip_data['London']
         cell_key = {'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
@@ -959,6 +1314,158 @@ class TestPositionSearcher(BaseLocateTest):
             ],
         )
 
+    def test_wifi_station_cache(self):
+        station_cache = StationCache()
+        wifis = [{'key': '001122334455'}, {'key': '112233445566'},
+                 {'key': '223344556677'}]
+        self.session.add(Wifi(
+            key=wifis[0]['key'], lat=GB_LAT, lon=GB_LON, range=200))
+        self.session.add(Wifi(
+            key=wifis[1]['key'], lat=GB_LAT, lon=GB_LON + 0.00001, range=300))
+        self.session.flush()
+
+        with self.db_call_checker() as check_db_calls:
+            first = self._make_query(
+                data={'wifi': wifis}, station_cache=station_cache)
+            check_db_calls(ro=1)
+
+        with self.db_call_checker() as check_db_calls:
+            second = self._make_query(
+                data={'wifi': wifis}, station_cache=station_cache)
+            check_db_calls(ro=0)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON + 0.000005,
+                          'accuracy': WIFI_MIN_ACCURACY})
+        self.check_stats(
+            counter=[
+                ('m.wifi.cache_miss', 1, '3'),
+                ('m.wifi.cache_hit', 1, '3'),
+            ],
+        )
+
+    def test_cell_station_cache(self):
+        station_cache = StationCache()
+        cell_key = {'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
+        self.session.add(Cell(
+            radio=Radio.gsm, cid=1, lat=GB_LAT, lon=GB_LON,
+            range=6000, **cell_key))
+        self.session.flush()
+        cells = [dict(radio=Radio.gsm.name, cid=1, **cell_key),
+                 dict(radio=Radio.gsm.name, cid=2, **cell_key)]
+
+        first = self._make_query(
+            data={'cell': cells}, station_cache=station_cache)
+        with self.db_call_checker() as check_db_calls:
+            second = self._make_query(
+                data={'cell': cells}, station_cache=station_cache)
+            check_db_calls(ro=0)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON,
+                          'accuracy': 6000})
+
+    def test_cell_area_index(self):
+        cell_area_index = CellAreaIndex()
+        cell_key = {'radio': Radio.gsm, 'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
+        self.session.add(CellArea(
+            lat=GB_LAT, lon=GB_LON, range=25000, **cell_key))
+        self.session.flush()
+        cell_area_index.prepare(self.session)
+        cells = [dict(cell_key, radio=Radio.gsm.name, cid=1)]
+
+        with self.db_call_checker() as check_db_calls:
+            result = self._make_query(
+                data={'cell': cells}, cell_area_index=cell_area_index)
+            # only the cell tables are queried
+            check_db_calls(ro=1)
+
+        self.assertEqual(result,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON,
+                          'accuracy': 25000})
+
+    def test_cell_area_index_loading(self):
+        # the index is still being loaded in the background
+        cell_area_index = CellAreaIndex(
+            session_factory=lambda: None, _spawn=lambda function: None)
+        cell_key = {'radio': Radio.gsm, 'mcc': GB_MCC, 'mnc': 1, 'lac': 1}
+        self.session.add(CellArea(
+            lat=GB_LAT, lon=GB_LON, range=25000, **cell_key))
+        self.session.flush()
+        cells = [dict(cell_key, radio=Radio.gsm.name, cid=1)]
+
+        result = self._make_query(
+            data={'cell': cells}, cell_area_index=cell_area_index)
+        self.assertTrue(cell_area_index.reloading)
+        self.assertEqual(result,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON,
+                          'accuracy': 25000})
+
+    def test_response_cache(self):
+        response_cache = ResponseCache()
+        wifis = [{'key': '001122334455'}, {'key': '112233445566'}]
+        self.session.add(Wifi(
+            key=wifis[0]['key'], lat=GB_LAT, lon=GB_LON, range=200))
+        self.session.add(Wifi(
+            key=wifis[1]['key'], lat=GB_LAT, lon=GB_LON + 0.00001, range=300))
+        self.session.flush()
+
+        first = self._make_query(
+            data={'wifi': wifis}, response_cache=response_cache,
+            api_key_log=True)
+        with self.db_call_checker() as check_db_calls:
+            second = self._make_query(
+                data={'wifi': list(reversed(wifis))},
+                response_cache=response_cache, api_key_log=True)
+            check_db_calls(ro=0)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first,
+                         {'lat': GB_LAT,
+                          'lon': GB_LON + 0.000005,
+                          'accuracy': WIFI_MIN_ACCURACY})
+        self.check_stats(
+            counter=[
+                ('m.response_cache.miss', 1),
+                ('m.response_cache.hit', 1),
+                ('m.wifi_hit', 2),
+                ('m.api_log.test.wifi_hit', 2),
+                ('m.plan.skip_cell', 2),
+            ],
+        )
+
+    def test_response_cache_geoip(self):
+        response_cache = ResponseCache()
+        london = self.geoip_data['London']
+        cells = [{'radio': Radio.gsm.name, 'mcc': GB_MCC, 'mnc': 1,
+                  'lac': 1, 'cid': 1}]
+
+        result = self._make_query(data={'cell': cells},
+                                  client_addr=london['ip'],
+                                  response_cache=response_cache)
+        self.assertEqual(result,
+                         {'lat': london['latitude'],
+                          'lon': london['longitude'],
+                          'accuracy': london['accuracy']})
+        self.assertEqual(len(response_cache.local), 0)
+
+        result = self._make_query(data={'cell': cells},
+                                  client_addr='127.0.0.1',
+                                  response_cache=response_cache)
+        self.assertTrue(result is None)
+        self.check_stats(
+            counter=[
+                ('m.response_cache.miss', 2),
+                ('m.response_cache.hit', 0),
+            ],
+        )
+
     def test_wifi_too_few_candidates(self):
         wifis = [
             Wifi(key='001122334455', lat=1.0, lon=1.0),
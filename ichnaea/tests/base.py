@@ -24,6 +24,7 @@ from ichnaea.async.config import (
     attach_redis_client,
     attach_stats_client,
     configure_s3_backup,
+    configure_observation_buffer,
     configure_ocid_import,
 )
 from ichnaea.cache import redis_client
@@ -307,11 +308,13 @@ class CeleryIsolation(object):
             'ocid_url': 'http://localhost:7001/downloads/',
             'ocid_apikey': 'xxxxxxxx-yyyy-xxxx-yyyy-xxxxxxxxxxxx',
         })
+        configure_observation_buffer(celery, settings={})
 
     @classmethod
     def teardown_celery(cls):
         del celery.s3_settings
         del celery.ocid_settings
+        del celery.observation_buffer
         del celery.db_rw
 
 
@@ -0,0 +1,177 @@
+from ichnaea.cache import (
+    configure_response_cache,
+    configure_station_cache,
+    ExpiringLRUCache,
+    ResponseCache,
+    StationCache,
+)
+from ichnaea.models.cell import (
+    CellAreaKey,
+    Radio,
+)
+from ichnaea.models.wifi import WifiKey
+from ichnaea.tests.base import (
+    RedisIsolation,
+    TestCase,
+)
+
+
+class TestExpiringLRUCache(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ExpiringLRUCache(
+            maxsize=2, ttl=10, _timer=lambda: self.now)
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('a', 0), 0)
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('a', None)
+        self.assertEqual(self.cache.get('a', 0), None)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+        self.now += 15
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('c'), 3)
+
+
+class TestStationCache(TestCase, RedisIsolation):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestStationCache, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestStationCache, cls).teardown_redis()
+
+    def tearDown(self):
+        self.cleanup_redis()
+
+    def test_local(self):
+        cache = StationCache()
+        key1 = WifiKey(key='001122334455')
+        key2 = WifiKey(key='112233445566')
+        cache.set_many('wifi', {key1: (1.0, 2.0, 10), key2: None})
+
+        found, missing = cache.get_many(
+            'wifi', [key1, key2, WifiKey(key='223344556677')])
+        self.assertEqual(found, {key1: (1.0, 2.0, 10), key2: None})
+        self.assertEqual(missing, [WifiKey(key='223344556677')])
+
+        found, missing = cache.get_many('other', [key1])
+        self.assertEqual(found, {})
+        self.assertEqual(missing, [key1])
+
+    def test_redis(self):
+        key1 = CellAreaKey(radio=Radio.umts, mcc=1, mnc=2, lac=3)
+        key2 = CellAreaKey(radio=Radio.gsm, mcc=1, mnc=2, lac=3)
+        cache = StationCache(redis_client=self.redis_client)
+        cache.set_many('cell_area', {key1: (1.0, 2.0, 10), key2: None})
+        self.assertEqual(
+            set(self.redis_client.keys('station_cache:cell_area:*')),
+            set(['station_cache:cell_area:0:1:2:3',
+                 'station_cache:cell_area:2:1:2:3']))
+
+        # a second worker only shares the redis cache
+        other_cache = StationCache(redis_client=self.redis_client)
+        found, missing = other_cache.get_many('cell_area', [key1, key2])
+        self.assertEqual(found, {key1: (1.0, 2.0, 10), key2: None})
+        self.assertEqual(missing, [])
+        self.assertEqual(len(other_cache.local), 2)
+
+    def test_redis_remaining_ttl(self):
+        key = WifiKey(key='001122334455')
+        cache = StationCache(redis_client=self.redis_client, ttl=300)
+        cache.set_many('wifi', {key: (1.0, 2.0, 10)})
+        self.redis_client.expire('station_cache:wifi:001122334455', 5)
+
+        now = 1000.0
+        other_cache = StationCache(redis_client=self.redis_client, ttl=300)
+        other_cache.local._timer = lambda: now
+        found, missing = other_cache.get_many('wifi', [key])
+        self.assertEqual(found, {key: (1.0, 2.0, 10)})
+        # the local entry expires together with the redis entry
+        expires, value = other_cache.local._data[('wifi', key)]
+        self.assertTrue(now < expires <= now + 5)
+
+    def test_configure(self):
+        self.assertTrue(configure_station_cache({}) is None)
+        cache = configure_station_cache(
+            {'station_cache_size': '100', 'station_cache_ttl': '60'},
+            redis_client=self.redis_client)
+        self.assertEqual(cache.local.maxsize, 100)
+        self.assertEqual(cache.ttl, 60)
+        self.assertTrue(cache.redis_client is None)
+
+        cache = configure_station_cache(
+            {'station_cache_size': '100', 'station_cache_redis': 'true'},
+            redis_client=self.redis_client)
+        self.assertTrue(cache.redis_client is self.redis_client)
+
+
+class TestResponseCache(TestCase, RedisIsolation):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestResponseCache, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestResponseCache, cls).teardown_redis()
+
+    def tearDown(self):
+        self.cleanup_redis()
+
+    def test_local(self):
+        cache = ResponseCache()
+        cache.set('position', 'abc', {'lat': 1.0, 'lon': 2.0})
+        self.assertEqual(cache.get('position', 'abc'),
+                         {'lat': 1.0, 'lon': 2.0})
+        self.assertTrue(cache.get('position', 'def') is None)
+        self.assertTrue(cache.get('country', 'abc') is None)
+
+    def test_redis(self):
+        cache = ResponseCache(redis_client=self.redis_client, ttl=30)
+        cache.set('position', 'abc', {'lat': 1.0, 'lon': 2.0})
+        self.assertEqual(self.redis_client.keys('response_cache:*'),
+                         ['response_cache:position:abc'])
+        self.assertTrue(
+            0 < self.redis_client.ttl('response_cache:position:abc') <= 30)
+
+        # a second worker only shares the redis cache
+        other_cache = ResponseCache(redis_client=self.redis_client)
+        self.assertEqual(other_cache.get('position', 'abc'),
+                         {'lat': 1.0, 'lon': 2.0})
+        self.assertEqual(len(other_cache.local), 1)
+        self.assertTrue(other_cache.get('position', 'def') is None)
+
+    def test_configure(self):
+        self.assertTrue(configure_response_cache({}) is None)
+        cache = configure_response_cache(
+            {'response_cache_size': '100', 'response_cache_ttl': '10'},
+            redis_client=self.redis_client)
+        self.assertEqual(cache.local.maxsize, 100)
+        self.assertEqual(cache.ttl, 10)
+        self.assertTrue(cache.redis_client is None)
+
+        cache = configure_response_cache(
+            {'response_cache_size': '100', 'response_cache_redis': 'true'},
+            redis_client=self.redis_client)
+        self.assertEqual(cache.ttl, 60)
+        self.assertTrue(cache.redis_client is self.redis_client)
@@ -6,7 +6,9 @@ import uuid
 import pytz
 
 from ichnaea.customjson import (
+    decode_columns,
     dumps,
+    encode_columns,
     kombu_dumps,
     kombu_loads,
     Renderer,
@@ -110,3 +112,34 @@ class TestKombuJson(TestCase):
         data = kombu_loads(kombu_dumps({'d': test_uuid}))
         self.assertEqual(data['d'], test_uuid)
         self.assertEqual(data['d'].version, 4)
+
+
+class TestColumns(TestCase):
+
+    def test_roundtrip(self):
+        report_id = uuid.uuid1()
+        now = util.utcnow()
+        entries = [
+            dict(key='%012x' % i, signal=-80 - i, lat=1.0, lon=2.0,
+                 time=now, report_id=report_id)
+            for i in range(3)]
+        entries.append(dict(key='%012x' % 3, lat=1.5, lon=2.0,
+                            time=now, report_id=uuid.uuid1()))
+        value = encode_columns(entries, shared=('lat', 'lon', 'time',
+                                                'report_id', 'accuracy'))
+        blocks = sorted(value['blocks'], key=lambda block: len(block['row']))
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[1]['fields'], ['key', 'signal'])
+        self.assertEqual(blocks[1]['columns'][1], [-80, -81, -82])
+        self.assertEqual(blocks[1]['shared'],
+                         ['lat', 'lon', 'time', 'report_id'])
+        self.assertEqual(blocks[1]['rows'],
+                         [[1.0, 2.0, now, report_id]])
+        self.assertEqual(blocks[1]['row'], [0, 0, 0])
+
+        result = decode_columns(kombu_loads(kombu_dumps(value)))
+        self.assertEqual(
+            sorted(result, key=lambda entry: entry['key']), entries)
+
+    def test_empty(self):
+        self.assertEqual(decode_columns(encode_columns([])), [])